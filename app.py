@@ -1,11 +1,28 @@
+import hashlib
 import os
 import pdb
+from datetime import timezone
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (Flask, render_template, request, flash, redirect, session, g,
+                   abort, Response, stream_with_context)
+from markupsafe import Markup
 from flask_debugtoolbar import DebugToolbarExtension
+from flask_migrate import Migrate
 from sqlalchemy.exc import IntegrityError
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message
+from assets import Assets
+from caching import TTLCache, LRUCache
+from compression import Compress
+from explain import check_pages, default_pages
+from hashing import HashingBusy
+from invalidation import create_bus
+from metrics import Metrics
+from replicas import Replicas
+from writebuffer import LikeBuffer
+from models import (db, connect_db, User, Message, TimelineEntry, Follows, Like,
+                    CurrentUser,
+                    MESSAGE_AUTHOR, USER_CARD)
+from pagination import paginate_before, paginate_after, InvalidCursor
 
 CURR_USER_KEY = "curr_user"
 
@@ -23,12 +40,92 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+# number of messages per page of the home feed and profiles; ?limit= can ask
+# for fewer or more, up to MAX_PAGE_SIZE
+app.config['FEED_PAGE_SIZE'] = int(os.environ.get('FEED_PAGE_SIZE', 20))
+app.config['PROFILE_PAGE_SIZE'] = int(os.environ.get('PROFILE_PAGE_SIZE', 20))
+app.config['MAX_PAGE_SIZE'] = int(os.environ.get('MAX_PAGE_SIZE', 100))
+# user cards per page of the directory and search results, and how far
+# search matches are counted
+app.config['USERS_PAGE_SIZE'] = int(os.environ.get('USERS_PAGE_SIZE', 30))
+app.config['SEARCH_COUNT_CAP'] = int(os.environ.get('SEARCH_COUNT_CAP', 1000))
+# send the user directory as it renders instead of building it in memory
+app.config['STREAM_USER_DIRECTORY'] = (
+    os.environ.get('STREAM_USER_DIRECTORY') == '1')
+# how long (seconds) each worker may reuse the logged-in user's profile and
+# counts before reloading them; 0 turns the cache off
+app.config['CURRENT_USER_CACHE_TTL'] = float(
+    os.environ.get('CURRENT_USER_CACHE_TTL', 30))
+# how workers tell each other to drop cached data: 'postgres' (NOTIFY) or
+# 'memory' (this process only; for tests and SQLite)
+app.config['INVALIDATION_BUS'] = os.environ.get(
+    'INVALIDATION_BUS',
+    'postgres' if database_url.startswith('postgresql') else 'memory')
+# bcrypt cost for new hashes; older hashes are upgraded at login. Hashing
+# runs in BCRYPT_WORKERS processes per web worker (0 = inline; by default the
+# CPUs are split between the WEB_CONCURRENCY web workers), see hashing.py
+app.config['WEB_CONCURRENCY'] = int(os.environ.get('WEB_CONCURRENCY', 1))
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+if 'BCRYPT_WORKERS' in os.environ:
+    app.config['BCRYPT_WORKERS'] = int(os.environ['BCRYPT_WORKERS'])
+# characters of rendered message <li>s each worker keeps; 0 turns it off
+app.config['FRAGMENT_CACHE_SIZE'] = int(
+    os.environ.get('FRAGMENT_CACHE_SIZE', 16 * 1024 * 1024))
+# page compression: bodies under COMPRESS_MIN_SIZE bytes are sent as they
+# are; higher levels are smaller but cost more CPU (see compression.py)
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+app.config['COMPRESS_GZIP_LEVEL'] = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+app.config['COMPRESS_BROTLI_LEVEL'] = int(
+    os.environ.get('COMPRESS_BROTLI_LEVEL', 4))
+# read-only copies of the database that some GET pages read from (comma
+# separated URLs; see replicas.py), and how long (seconds) a user who just
+# changed something reads from the primary instead
+app.config['DATABASE_REPLICA_URLS'] = [
+    url.replace('postgres://', 'postgresql://')
+    for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]
+app.config['REPLICA_PIN_SECONDS'] = float(
+    os.environ.get('REPLICA_PIN_SECONDS', 10))
+# write scripted likes in batches every LIKE_BUFFER_SECONDS instead of one
+# by one; see writebuffer.py
+app.config['LIKE_BUFFER_ENABLED'] = os.environ.get('LIKE_BUFFER_ENABLED') == '1'
+app.config['LIKE_BUFFER_SECONDS'] = float(
+    os.environ.get('LIKE_BUFFER_SECONDS', 0.05))
+# the Prometheus endpoint (see metrics.py) is off unless METRICS_PATH is set,
+# and then only answers scrapes sending METRICS_TOKEN as a bearer token or
+# coming from METRICS_ALLOWED_IPS (comma separated addresses or networks)
+app.config['METRICS_PATH'] = os.environ.get('METRICS_PATH') or None
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN') or None
+app.config['METRICS_ALLOWED_IPS'] = [
+    address for address in os.environ.get('METRICS_ALLOWED_IPS', '').split(',')
+    if address]
+# how long (seconds) browsers may use static files without asking again
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = int(
+    os.environ.get('STATIC_MAX_AGE', 7 * 24 * 60 * 60))
 # added line below
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 # toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
 
+# schema changes are versioned in migrations/; `flask db upgrade` applies them
+migrate = Migrate(app, db, directory=os.path.join(app.root_path, 'migrations'))
+
+# GET pages marked @replicas.read_only read from a replica, if there are any
+replicas = Replicas(db)
+replicas.init_app(app)
+
+# SQL, render and total time per endpoint; see metrics.py
+metrics = Metrics()
+metrics.init_app(app)
+
+# fingerprinted static files at /assets/, built by `python assets.py`
+assets = Assets()
+assets.init_app(app)
+
+# gzip/brotli for pages
+compress = Compress()
+compress.init_app(app)
+
 print('database url is ', database_url)
 
 
@@ -36,17 +133,77 @@ print('database url is ', database_url)
 # User signup/login/logout
 
 
+# CurrentUser snapshots by user id, shared by the requests in this worker
+current_user_cache = TTLCache(ttl=app.config['CURRENT_USER_CACHE_TTL'])
+
+# evicts cached snapshots in every worker when users change; see
+# invalidation.py
+invalidation = create_bus(app.config['INVALIDATION_BUS'], db)
+invalidation.subscribe('user', current_user_cache.pop, current_user_cache.clear)
+
+
+@app.before_request
+def start_invalidation_listener():
+    """Listen for other workers' changes (once per worker process)."""
+
+    invalidation.start()
+
+
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    This is a cached `CurrentUser` snapshot, not a `User`; routes that change
+    the user should call `load_current_user`.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = get_current_user(session[CURR_USER_KEY])
 
     else:
         g.user = None
 
 
+def get_current_user(user_id):
+    """Return a `CurrentUser` for `user_id`, from the cache when possible, or
+    None if there's no such user."""
+
+    current_user = current_user_cache.get(user_id)
+
+    if current_user is None:
+        # cached snapshots outlive the request, so never take one from a
+        # replica that may be behind
+        with replicas.primary():
+            user = User.query.get(user_id)
+
+        if user is None:
+            return None
+
+        current_user = CurrentUser.from_user(user)
+        current_user_cache.set(user_id, current_user)
+
+    return current_user
+
+
+def load_current_user():
+    """Load the full `User` row for the logged-in user, for routes that
+    change it."""
+
+    return User.query.get_or_404(g.user.id)
+
+
+def forget_users(*user_ids):
+    """Drop cached snapshots of users whose profile or counts change in the
+    current transaction, in every worker, once it commits."""
+
+    invalidation.publish('user', user_ids)
+
+
+# likes made by the page's script, written in batches (if enabled)
+like_buffer = LikeBuffer(forget_users)
+like_buffer.init_app(app)
+
+
 def do_login(user):
     """Log in user."""
 
@@ -107,6 +264,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # saves the password hash if authenticate upgraded it
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -125,36 +284,152 @@ def logout():
     return redirect('/login')
 
 
+##############################################################################
+# Follow lookups for templates
+
+
+def prefetch_following(user_ids):
+    """Find out which of `user_ids` the current user follows with a single
+    query, remembering the answers for the rest of the request."""
+
+    known = g.setdefault('following_ids', {})
+    missing = [user_id for user_id in user_ids if user_id not in known]
+
+    if missing:
+        followed = g.user.following_ids_among(missing)
+        known.update((user_id, user_id in followed) for user_id in missing)
+
+
+@app.template_global()
+def viewer_follows(user_id):
+    """Does the current user follow `user_id`?
+
+    Routes that show many users should call `prefetch_following` first so
+    this is answered from the per-request cache.
+    """
+
+    if not g.user:
+        return False
+
+    prefetch_following([user_id])
+    return g.following_ids[user_id]
+
+
+##############################################################################
+# Message fragments for templates
+
+
+# rendered message <li>s, shared by the requests in this worker
+fragment_cache = LRUCache(max_size=app.config['FRAGMENT_CACHE_SIZE'],
+                          sizeof=lambda parts: sum(map(len, parts)))
+
+# stands in for the viewer's like button in cached fragments; user content
+# is escaped, so it can't contain this
+LIKE_BUTTON_SLOT = Markup('<!--like-button-->')
+
+
+@app.template_global()
+def message_item(msg, liked_ids=None):
+    """Render the <li> for `msg`, from the fragment cache when possible.
+
+    Messages never change, so a fragment is good for as long as its author
+    keeps the same username and picture, which are part of the key. With
+    `liked_ids` it's the timeline item, and the viewer's like button is put
+    into the cached fragment on every call; without, the profile item.
+    """
+
+    if liked_ids is None:
+        template_name = 'messages/profile_list_item.html'
+    else:
+        template_name = 'messages/list_item.html'
+
+    author = msg.user
+    key = (template_name, msg.id, author.username, author.image_url)
+    parts = fragment_cache.get(key)
+
+    if parts is None:
+        html = app.jinja_env.get_template(template_name).render(
+            msg=msg, like_button=LIKE_BUTTON_SLOT)
+        parts = tuple(html.split(LIKE_BUTTON_SLOT))
+        fragment_cache.set(key, parts)
+
+    if len(parts) == 1:
+        return Markup(parts[0])
+
+    return Markup(like_button(msg, liked_ids)).join(parts)
+
+
+def like_button(msg, liked_ids):
+    """The viewer's like/unlike button for `msg` (none on their own)."""
+
+    if msg.id in liked_ids:
+        state = 'liked'
+    elif msg.user_id != g.user.id:
+        state = 'not_liked'
+    else:
+        state = None
+
+    return app.jinja_env.get_template('messages/like_button.html').render(
+        msg_id=msg.id, state=state)
+
+
 ##############################################################################
 # General user routes:
 
 @app.route('/users')
+@replicas.read_only
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username; search
+    results are paged with ?page=, the full directory with ?after=<user id>.
     """
 
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
+        users = paginate_after(User.query.options(USER_CARD),
+                               User.id,
+                               request.args.get('after', type=int),
+                               get_page_size('USERS_PAGE_SIZE'))
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = User.search(search,
+                            request.args.get('page', 1, type=int),
+                            get_page_size('USERS_PAGE_SIZE'),
+                            app.config['SEARCH_COUNT_CAP'])
 
-    return render_template('users/index.html', users=users)
+    if g.user:
+        prefetch_following(user.id for user in users)
+
+    if app.config['STREAM_USER_DIRECTORY']:
+        return stream_template('users/index.html', users=users, search=search)
+
+    return render_template('users/index.html', users=users, search=search)
 
 
 @app.route('/users/<int:user_id>')
+@replicas.read_only
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile, with a page of their messages (older pages via
+    ?before=<cursor>)."""
 
     user = User.query.get_or_404(user_id)
 
-    return render_template('users/show.html', user=user)
+    # the messages shown change only with user.messages_count
+    unchanged = not_modified(user)
+    if unchanged:
+        return unchanged
+
+    messages = paginate_or_400(Message.query.filter_by(user_id=user.id),
+                               Message.timestamp,
+                               Message.id,
+                               'PROFILE_PAGE_SIZE')
+
+    return render_template('users/show.html', user=user, messages=messages)
 
 
 @app.route('/users/<int:user_id>/following')
+@replicas.read_only
 def show_following(user_id):
     """Show list of people this user is following."""
     if not g.user:
@@ -162,10 +437,15 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    following = user.following.options(USER_CARD).all()
+    prefetch_following(followed.id for followed in following)
+    return render_template('users/following.html',
+                           user=user,
+                           following=following)
 
 
 @app.route('/users/<int:user_id>/followers')
+@replicas.read_only
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -174,7 +454,11 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    followers = user.followers.options(USER_CARD).all()
+    prefetch_following(follower.id for follower in followers)
+    return render_template('users/followers.html',
+                           user=user,
+                           followers=followers)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -185,9 +469,24 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    # a user's own messages are always in their feed; following themselves
+    # would deliver each one twice
+    if follow_id == g.user.id:
+        abort(400)
+
+    try:
+        added = Follows.add(g.user.id, follow_id)
+    except IntegrityError:
+        # no such user
+        db.session.rollback()
+        abort(404)
+
+    # following twice (a double click) changes nothing
+    if added:
+        TimelineEntry.backfill(g.user.id, follow_id)
+        User.adjust_follow_counts(g.user.id, follow_id, 1)
+        forget_users(g.user.id, follow_id)
+        db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -200,9 +499,14 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    if Follows.remove(g.user.id, follow_id):
+        # a self-follow left over from before add_follow refused them; the
+        # user's own messages stay in their feed
+        if follow_id != g.user.id:
+            TimelineEntry.trim(g.user.id, follow_id)
+        User.adjust_follow_counts(g.user.id, follow_id, -1)
+        forget_users(g.user.id, follow_id)
+        db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -227,13 +531,15 @@ def profile():
             flash("Access unauthorized.", "danger")
             return redirect('/')
         
-        g.user.username = form.username.data or g.user.username
-        g.user.email = form.email.data or g.user.email
-        g.user.image_url = form.image_url.data or g.user.image_url
-        g.user.header_image_url = (form.header_image_url.data 
-                            or g.user.header_image_url)
-        g.user.bio = form.bio.data or g.user.bio
-
+        user = load_current_user()
+        user.username = form.username.data or user.username
+        user.email = form.email.data or user.email
+        user.image_url = form.image_url.data or user.image_url
+        user.header_image_url = (form.header_image_url.data 
+                            or user.header_image_url)
+        user.bio = form.bio.data or user.bio
+
+        forget_users(user.id)
         db.session.commit()
 
         return redirect(f'/users/{g.user.id}')
@@ -251,7 +557,33 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # the rows pointing at this user go away with it, so take them off the
+    # counts of the users on the other end
+    followed_ids = db.session.execute(
+        db.select(Follows.user_being_followed_id)
+        .where(Follows.user_following_id == g.user.id)).scalars().all()
+    follower_ids = db.session.execute(
+        db.select(Follows.user_following_id)
+        .where(Follows.user_being_followed_id == g.user.id)).scalars().all()
+    likes_by_user = db.session.execute(
+        db.select(Like.users_id, db.func.count())
+        .join(Message, Message.id == Like.message_id)
+        .where(Message.user_id == g.user.id)
+        .group_by(Like.users_id)).all()
+
+    User.adjust_counts(followed_ids, followers_count=-1)
+    User.adjust_counts(follower_ids, following_count=-1)
+
+    # one UPDATE per distinct number of likes, rather than per liker
+    likers_by_count = {}
+    for user_id, count in likes_by_user:
+        likers_by_count.setdefault(count, []).append(user_id)
+    for count, user_ids in likers_by_count.items():
+        User.adjust_counts(user_ids, likes_count=-count)
+
+    db.session.delete(load_current_user())
+    forget_users(g.user.id, *followed_ids, *follower_ids,
+                 *(user_id for user_id, _ in likes_by_user))
     db.session.commit()
 
     return redirect("/signup")
@@ -274,8 +606,12 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        TimelineEntry.fan_out(msg)
+        User.adjust_counts(g.user.id, messages_count=1)
+        forget_users(g.user.id)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -284,10 +620,17 @@ def messages_add():
 
 
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@replicas.read_only
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = Message.query.options(MESSAGE_AUTHOR).get_or_404(message_id)
+
+    # messages are never edited, so only their author can change the page
+    unchanged = not_modified(msg.user, last_modified=msg.timestamp)
+    if unchanged:
+        return unchanged
+
     return render_template('messages/show.html', message=msg)
 
 
@@ -300,7 +643,15 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    author_id = msg.user_id
+    liker_ids = db.session.execute(
+        db.select(Like.users_id).where(Like.message_id == msg.id)
+    ).scalars().all()
+
+    User.adjust_counts(author_id, messages_count=-1)
+    User.adjust_counts(liker_ids, likes_count=-1)
     db.session.delete(msg)
+    forget_users(author_id, *liker_ids)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}")
@@ -311,18 +662,48 @@ def messages_destroy(message_id):
 # Likes 
 
 
+def wants_json():
+    """Was this request made by a script wanting JSON rather than a page,
+    like the like buttons' (static/js/likes.js)?"""
+
+    return request.accept_mimetypes.best == 'application/json'
+
+
 @app.route('/messages/<int:message_id>/like', methods=['POST'])
 def messages_like(message_id):
-    """Add a like to this message for the currently-logged-in user."""
+    """Add a like to this message for the currently-logged-in user.
+
+    A form post is sent back to the feed; a script asking for JSON gets an
+    empty 204, so a click costs the like's INSERT and the counter UPDATE.
+    With the like buffer on, a script's like is queued for the next batch
+    instead, and answered with a 202.
+    """
 
     if not g.user:
+        if wants_json():
+            abort(401)
         flash("You must be logged in to like a message.", "danger")
         return redirect("/")
 
-    liked_message = Message.query.get_or_404(message_id)
-    
-    g.user.liked_messages.append(liked_message)
-    db.session.commit()
+    if like_buffer.enabled and wants_json():
+        like_buffer.add(g.user.id, message_id, liked=True)
+        replicas.note_write()
+        return '', 202
+
+    try:
+        added = Like.add(g.user.id, message_id)
+    except IntegrityError:
+        # no such message
+        db.session.rollback()
+        abort(404)
+
+    if added:
+        User.adjust_counts(g.user.id, likes_count=1)
+        forget_users(g.user.id)
+        db.session.commit()
+
+    if wants_json():
+        return '', 204
 
     return redirect("/")
 
@@ -332,23 +713,39 @@ def messages_like(message_id):
 
 @app.route('/messages/<int:message_id>/unlike', methods=['POST'])
 def messages_unlike(message_id):
-    """Have currently-logged-in-user unlike this message."""
+    """Have currently-logged-in-user unlike this message.
+
+    Answers scripts with a 204 (202 if buffered), like `messages_like`.
+    """
 
     if not g.user:
+        if wants_json():
+            abort(401)
         flash("You must be logged in to unlike a message.", "danger")
         return redirect("/")
         # would be better if we could go to liked_messages if coming from liked_messages
         # or home if coming from home... instead of default home
 
-    unliked_message = Message.query.get_or_404(message_id)
+    if like_buffer.enabled and wants_json():
+        like_buffer.add(g.user.id, message_id, liked=False)
+        replicas.note_write()
+        return '', 202
 
-    g.user.liked_messages.remove(unliked_message)
-    db.session.commit()
+    unliked = Like.remove(g.user.id, message_id)
+
+    if unliked:
+        User.adjust_counts(g.user.id, likes_count=-1)
+        forget_users(g.user.id)
+        db.session.commit()
+
+    if wants_json():
+        return '', 204
 
     return redirect("/")
 
 
 @app.route('/users/<int:user_id>/liked_messages')
+@replicas.read_only
 def show_liked_messages(user_id):
     """Show list of messages this user has liked."""
     
@@ -357,7 +754,18 @@ def show_liked_messages(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/liked_messages.html', user=user)
+    liked_messages = user.liked_messages.options(MESSAGE_AUTHOR).all()
+
+    if user.id == g.user.id:
+        liked_ids = {msg.id for msg in liked_messages}
+    else:
+        liked_ids = Like.liked_ids(g.user.id,
+                                   [msg.id for msg in liked_messages])
+
+    return render_template('users/liked_messages.html',
+                           user=user,
+                           liked_messages=liked_messages,
+                           liked_ids=liked_ids)
 
 
 # # nice to have for later
@@ -375,50 +783,222 @@ def show_liked_messages(user_id):
 #     return render_template("messages/users_who_like.html", user=message.user, message=message)
 
 
+##############################################################################
+# Pagination helpers
+
+
+def get_page_size(default_key):
+    """Page size from ?limit=, falling back to app.config[default_key] and
+    capped at MAX_PAGE_SIZE."""
+
+    page_size = request.args.get('limit', type=int) or app.config[default_key]
+    return max(1, min(page_size, app.config['MAX_PAGE_SIZE']))
+
+
+def paginate_or_400(query, timestamp_col, id_col, default_key):
+    """Keyset-paginate `query` from ?before=; a garbled cursor is a 400."""
+
+    try:
+        return paginate_before(query,
+                               timestamp_col,
+                               id_col,
+                               request.args.get('before'),
+                               get_page_size(default_key))
+    except InvalidCursor:
+        abort(400)
+
+
+def stream_template(template_name, **context):
+    """Render a template a chunk at a time as the response is sent.
+
+    Like Flask 2.2's `stream_template`, which this version of Flask lacks.
+    """
+
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+
+    return Response(stream_with_context(template.generate(context)))
+
+
 ##############################################################################
 # Homepage and error pages
 
 
 @app.route('/', methods=['GET','POST'])
+@replicas.read_only
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: a page of the most recent messages of followed_users,
+      older pages via ?before=<cursor>
     """
 
     if not g.user:
         return render_template('home-anon.html')
-    
-    # TODO: set forms to have likes populated 
-   
-    # gets followers ids
-    user_and_followers_ids = [user.id for user in g.user.following]
 
-    # adds user's id
-    user_and_followers_ids.append(g.user.id)
-
-    messages = (Message
+    # the timeline is filled on write, so this is one range scan over
+    # the user's own entries
+    timeline = (Message
                 .query
-                .filter(Message.user_id.in_(user_and_followers_ids))
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
+                .options(MESSAGE_AUTHOR)
+                .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+                .filter(TimelineEntry.user_id == g.user.id))
+
+    messages = paginate_or_400(timeline,
+                               TimelineEntry.timestamp,
+                               TimelineEntry.message_id,
+                               'FEED_PAGE_SIZE')
+
+    liked_ids = Like.liked_ids(g.user.id, [msg.id for msg in messages])
+
+    return render_template('home.html', messages=messages, liked_ids=liked_ids)
+
+
+@app.errorhandler(HashingBusy)
+def hashing_busy(error):
+    """Too many logins/signups queued for the password hashing pool."""
 
-    return render_template('home.html', messages=messages)
+    return "Too many sign-ins right now; please try again.", 503, {
+        'Retry-After': '1',
+    }
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# Maintenance commands
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines():
+    """Rebuild every home timeline from the messages and follows tables."""
+
+    TimelineEntry.rebuild()
+    db.session.commit()
+    print('timelines rebuilt')
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters():
+    """Recompute users' message/follow/like counts from the source tables."""
+
+    User.reconcile_counts()
+    invalidation.publish('user')
+    db.session.commit()
+    print('counters reconciled')
+
+
+@app.cli.command('check-plans')
+def check_plans():
+    """EXPLAIN the queries behind the busiest pages; fail if any of them
+    reads a whole table or index (see explain.py)."""
+
+    engines = [db.engine] + replicas.engines
+    if any(engine.dialect.name != 'postgresql' for engine in engines):
+        raise SystemExit('check-plans needs Postgres, replicas included')
+
+    pages = default_pages()
+    if pages is None:
+        raise SystemExit('check-plans needs some users and messages')
+
+    viewer, urls = pages
+    scans = check_pages(app, urls, {CURR_USER_KEY: viewer.id})
+
+    for scan in scans:
+        print(f"{scan.url}: full scan of {', '.join(scan.tables)}")
+        print(f"    {' '.join(scan.statement.split())}")
+
+    if scans:
+        raise SystemExit(1)
+
+    print(f'no full scans on {len(urls)} pages')
+
+
+##############################################################################
+# HTTP caching
 #
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Static files may be cached for SEND_FILE_MAX_AGE_DEFAULT, and built ones
+# (/assets/, see assets.py) forever. Pages that call
+# `not_modified` get validators and are revalidated on every visit, which
+# costs a 304 instead of a render when nothing changed. Everything else is
+# never stored, since it may show private or fast-changing data.
+
+
+def templates_version():
+    """Hash every template, so a deploy that changes the pages also changes
+    their ETags (and is the same in every worker)."""
+
+    digest = hashlib.sha1()
+
+    for name in sorted(app.jinja_env.list_templates()):
+        source, _, _ = app.jinja_loader.get_source(app.jinja_env, name)
+        digest.update(name.encode())
+        digest.update(source.encode())
+
+    return digest.hexdigest()
+
+
+TEMPLATES_VERSION = templates_version()
+
+
+def not_modified(*users, last_modified=None):
+    """Validate a page that only changes when `users` (or the viewer) do.
+
+    The ETag is built from the row versions (`updated_at`) of `users` and
+    the logged-in user, the URL and the templates; Last-Modified is the
+    newest of those times and `last_modified`. Returns a 304 response when
+    the browser's copy is still current, otherwise None and the page should
+    be rendered as usual (it'll be sent with the same validators).
+    """
+
+    users = [*users, g.user]
+    versions = [TEMPLATES_VERSION, request.full_path]
+    versions += [(user.id, user.updated_at) for user in users if user]
+    etag = hashlib.sha1(repr(versions).encode()).hexdigest()
+
+    times = [user.updated_at for user in users if user and user.updated_at]
+    if last_modified:
+        times.append(last_modified)
+    newest = max(times, default=None)
+
+    g.page_validators = (etag, newest)
+
+    # a flashed message is shown once, so that page must be rendered
+    if '_flashes' in session:
+        return None
+
+    if request.if_none_match:
+        unchanged = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and newest:
+        # Last-Modified is sent in whole seconds (and in UTC)
+        newest = newest.replace(microsecond=0, tzinfo=timezone.utc)
+        unchanged = newest <= request.if_modified_since
+    else:
+        unchanged = False
+
+    return Response(status=304) if unchanged else None
+
 
 @app.after_request
-def add_header(response):
-    """Add non-caching headers on every request."""
+def add_cache_headers(response):
+    """Apply the caching policy described above."""
+
+    if request.endpoint in ('static', 'assets'):
+        # send_file has already set a public max-age
+        return response
+
+    validators = g.get('page_validators')
+
+    if validators and response.status_code in (200, 304):
+        etag, newest = validators
+        # weak, since compression may change the bytes but not the page
+        response.set_etag(etag, weak=True)
+        if newest:
+            response.last_modified = newest.replace(tzinfo=timezone.utc)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+    else:
+        # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
+        response.cache_control.no_store = True
 
-    # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
     return response
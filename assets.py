@@ -0,0 +1,199 @@
+"""Fingerprinted, precompressed static files.
+
+    python assets.py
+
+Copies everything in static/ to static/dist/ under a name containing a
+hash of its contents (style.css -> style.3f9c0a1b2d4e.css), along with
+gzip and brotli versions of the files that compress well, and writes a
+manifest mapping the plain names to the hashed ones. Stylesheets are
+rewritten to point at the hashed images they use.
+
+The app serves those files at /assets/<name> (see `Assets`). They can be
+cached forever, since a changed file gets a new name, and each browser
+gets the smallest encoding it accepts. Templates link to them with
+`asset_url('stylesheets/style.css')`, which falls back to /static/ until
+the build has been run.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+
+from flask import abort, request, send_from_directory, url_for
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # brotli versions are skipped
+    brotli = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(HERE, 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST_NAME = 'manifest.json'
+
+# files worth compressing; images are compressed already
+COMPRESSIBLE = ('.css', '.js', '.svg', '.ico', '.txt', '.json')
+
+# characters of hash in fingerprinted names
+HASH_LENGTH = 12
+
+# a year, the most caches honour
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# url("/static/...") references inside stylesheets
+CSS_URL = re.compile(r'''url\((['"]?)/static/([^'")]+)\1\)''')
+
+# (Accept-Encoding name, file suffix), best first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def fingerprint(name, content):
+    """`name` with a hash of `content` before its extension."""
+
+    stem, ext = os.path.splitext(name)
+    digest = hashlib.sha256(content).hexdigest()[:HASH_LENGTH]
+    return f"{stem}.{digest}{ext}"
+
+
+def source_files(static_dir):
+    """Paths (relative to `static_dir`, with /) of the files to build,
+    stylesheets last so the images they use are built first."""
+
+    names = []
+
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = [d for d in dirs
+                   if os.path.join(root, d) != os.path.join(static_dir, 'dist')]
+        for filename in files:
+            path = os.path.relpath(os.path.join(root, filename), static_dir)
+            names.append(path.replace(os.sep, '/'))
+
+    return sorted(names, key=lambda name: (name.endswith('.css'), name))
+
+
+def write_compressed(path, content):
+    """Write gzip and brotli versions of `path` when they're smaller."""
+
+    variants = [('.gz', gzip.compress(content, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(content, quality=11)))
+
+    for suffix, compressed in variants:
+        if len(compressed) < len(content):
+            with open(path + suffix, 'wb') as out:
+                out.write(compressed)
+
+
+def build(static_dir=STATIC_DIR, dist_dir=DIST_DIR):
+    """Build `dist_dir` from `static_dir`; returns the manifest."""
+
+    shutil.rmtree(dist_dir, ignore_errors=True)
+    os.makedirs(dist_dir)
+    manifest = {}
+
+    def hashed_url(match):
+        quote, name = match.groups()
+        return f"url({quote}/assets/{manifest.get(name, name)}{quote})"
+
+    for name in source_files(static_dir):
+        with open(os.path.join(static_dir, name), 'rb') as source:
+            content = source.read()
+
+        if name.endswith('.css'):
+            content = CSS_URL.sub(hashed_url, content.decode()).encode()
+
+        hashed = fingerprint(name, content)
+        manifest[name] = hashed
+
+        path = os.path.join(dist_dir, hashed)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as out:
+            out.write(content)
+
+        if name.endswith(COMPRESSIBLE):
+            write_compressed(path, content)
+
+    with open(os.path.join(dist_dir, MANIFEST_NAME), 'w') as out:
+        json.dump(manifest, out, indent=2, sort_keys=True)
+
+    return manifest
+
+
+class Assets:
+    """Serves the built files at /assets/<name> and provides `asset_url`
+    to templates.
+
+    Settings (app.config):
+
+    - ASSETS_DIST_DIR: where `build` put the files (default static/dist)
+    """
+
+    def __init__(self):
+        self.manifest = {}
+
+    def init_app(self, app):
+        self.dist_dir = app.config.setdefault('ASSETS_DIST_DIR', DIST_DIR)
+        self.load_manifest()
+
+        app.add_url_rule('/assets/<path:filename>', 'assets', self.send_asset)
+        app.add_template_global(self.asset_url)
+
+    def load_manifest(self):
+        """Read the manifest written by `build`, if there is one."""
+
+        try:
+            with open(os.path.join(self.dist_dir, MANIFEST_NAME)) as manifest:
+                self.manifest = json.load(manifest)
+        except FileNotFoundError:
+            self.manifest = {}
+
+    def asset_url(self, name):
+        """URL of static file `name`: its fingerprinted copy once built."""
+
+        hashed = self.manifest.get(name)
+
+        if hashed is None:
+            return url_for('static', filename=name)
+
+        return url_for('assets', filename=hashed)
+
+    def send_asset(self, filename):
+        """Send a built file, precompressed if the browser accepts that."""
+
+        path = safe_join(self.dist_dir, filename)
+        if path is None:
+            abort(404)
+
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        variants = [(name, suffix) for name, suffix in ENCODINGS
+                    if os.path.isfile(path + suffix)]
+        encoding = None
+
+        for name, suffix in variants:
+            if request.accept_encodings[name]:
+                encoding = name
+                filename += suffix
+                break
+
+        response = send_from_directory(self.dist_dir,
+                                       filename,
+                                       mimetype=mimetype,
+                                       max_age=IMMUTABLE_MAX_AGE)
+
+        if encoding:
+            response.content_encoding = encoding
+        if variants:
+            response.vary.add('Accept-Encoding')
+        response.cache_control.immutable = True
+
+        return response
+
+
+if __name__ == '__main__':
+    built = build()
+    print(f"built {len(built)} files into {os.path.relpath(DIST_DIR)}")
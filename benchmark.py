@@ -0,0 +1,552 @@
+"""Load test and benchmark the Warbler routes.
+
+    python benchmark.py --database postgresql:///warbler-bench \\
+        --users 2000 --messages 20000 --follows 60000 --likes 20000 \\
+        --mode both --requests 200 --output results.json
+
+    python benchmark.py --skip-seed --compare results.json
+
+Seeds a generated dataset (see generator/create_csvs.py) into a separate
+database, then drives the hot routes two ways:
+
+- client: the Flask test client, in this process.
+- gunicorn: a real gunicorn server over HTTP, with --concurrency threads.
+
+(--mode compression instead measures the size and CPU cost of compressing
+the biggest pages at each gzip and brotli level.)
+
+For each route it reports p50/p95/p99/mean latency, throughput and queries
+per request (counted in-process, or read from the Server-Timing header), and
+writes them as JSON so runs can be compared with --compare.
+"""
+
+import argparse
+import http.cookiejar
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import perf_counter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# every generated user has this password (see generator/create_csvs.py)
+GENERATED_PASSWORD = 'password'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the Warbler routes.")
+    parser.add_argument('--database', default='postgresql:///warbler-bench',
+                        help="database to seed and run against (dropped!)")
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=60000)
+    parser.add_argument('--likes', type=int, default=20000)
+    parser.add_argument('--skip-seed', action='store_true',
+                        help="reuse the data already in --database")
+    parser.add_argument('--mode',
+                        choices=['client', 'gunicorn', 'both', 'compression'],
+                        default='client')
+    parser.add_argument('--requests', type=int, default=100,
+                        help="requests per route")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="client threads in gunicorn mode")
+    parser.add_argument('--workers', type=int, default=2,
+                        help="gunicorn worker processes")
+    parser.add_argument('--output', help="write results as JSON here")
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help="print changes against an earlier --output file")
+    return parser.parse_args()
+
+
+##############################################################################
+# Dataset
+
+
+def seed_dataset(args):
+    """Generate CSVs for the requested sizes and load them."""
+
+    from seed import seed
+
+    with tempfile.TemporaryDirectory() as csv_dir:
+        subprocess.run([
+            sys.executable, os.path.join(HERE, 'generator', 'create_csvs.py'),
+            '--users', str(args.users),
+            '--messages', str(args.messages),
+            '--follows', str(args.follows),
+            '--likes', str(args.likes),
+            '--out', csv_dir,
+        ], check=True)
+
+        seed(csv_dir, chunk_rows=50000)
+
+
+def pick_targets(count):
+    """Choose the users and messages the scenarios act on, for `count`
+    concurrent clients.
+
+    Each client is a different viewer (so their follow/like pairs never race
+    each other), taken from the users following the most accounts: the
+    heaviest home feeds. Viewers who already follow everyone, or have liked
+    every message they could, are passed over. The profile is the most
+    prolific poster's, and the search is for the start of the viewer's name,
+    long enough to use the trigram index where there is one.
+    """
+
+    from models import db, User, Message, Follows, TRIGRAM_MIN_LENGTH
+
+    candidates = User.query.order_by(User.following_count.desc(), User.id)
+    author = User.query.order_by(User.messages_count.desc()).first()
+    targets = []
+    offset = 0
+
+    while len(targets) < count:
+        viewers = candidates.offset(offset).limit(count).all()
+        if not viewers:
+            break
+        offset += len(viewers)
+
+        for viewer in viewers:
+            if len(targets) == count:
+                break
+
+            followed = db.select(Follows.user_being_followed_id).where(
+                Follows.user_following_id == viewer.id)
+            stranger = (User.query
+                        .filter(User.id != viewer.id,
+                                User.id.notin_(followed))
+                        .first())
+            message = (Message.query
+                       .filter(Message.user_id != viewer.id)
+                       .filter(~Message.users_who_like.any(
+                           User.id == viewer.id))
+                       .first())
+
+            if stranger is None or message is None:
+                continue
+
+            targets.append({
+                'viewer_id': viewer.id,
+                'viewer_username': viewer.username,
+                'author_id': author.id,
+                'search': viewer.username[:TRIGRAM_MIN_LENGTH],
+                'stranger_id': stranger.id,
+                'message_id': message.id,
+            })
+
+    if len(targets) < count:
+        raise SystemExit(
+            f"only {len(targets)} users have someone left to follow and a "
+            f"message left to like; --concurrency {count} needs that many "
+            "(seed a bigger dataset)")
+
+    return targets
+
+
+def scenarios(targets):
+    """(name, method, path, form data) for each measured route.
+
+    Follows and likes come in do/undo pairs, so repeated runs keep measuring
+    the same work; posting adds a message each time.
+    """
+
+    t = targets
+
+    return [
+        ('home', 'GET', '/', None),
+        ('profile', 'GET', f"/users/{t['author_id']}", None),
+        ('search', 'GET', f"/users?q={t['search']}", None),
+        ('directory', 'GET', '/users', None),
+        ('follow', 'POST', f"/users/follow/{t['stranger_id']}", None),
+        ('unfollow', 'POST', f"/users/stop-following/{t['stranger_id']}", None),
+        ('like', 'POST', f"/messages/{t['message_id']}/like", None),
+        ('unlike', 'POST', f"/messages/{t['message_id']}/unlike", None),
+        ('post', 'POST', '/messages/new', {'text': 'Benchmark warble'}),
+    ]
+
+
+def run_rounds(routes, rounds, send):
+    """Call `send(route)` `rounds` times per route, interleaving do/undo
+    pairs; returns {name: [(seconds, status, queries), ...]}."""
+
+    samples = {name: [] for name, *_ in routes}
+
+    for _ in range(rounds):
+        for route in routes:
+            samples[route[0]].append(send(route))
+
+    return samples
+
+
+##############################################################################
+# Test client mode
+
+
+def run_client(targets, rounds):
+    """Drive the app in-process; returns per-route samples and wall time."""
+
+    from sqlalchemy import event
+
+    from app import app, CURR_USER_KEY
+    from models import db
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    client = app.test_client()
+
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = targets['viewer_id']
+
+    statements = []
+
+    def count_statement(*args):
+        statements.append(1)
+
+    def send(route):
+        name, method, path, data = route
+        statements.clear()
+        started = perf_counter()
+        resp = client.open(path, method=method, data=data)
+        resp.get_data()
+        return perf_counter() - started, resp.status_code, len(statements)
+
+    event.listen(db.engine, 'before_cursor_execute', count_statement)
+    try:
+        started = perf_counter()
+        samples = run_rounds(scenarios(targets), rounds, send)
+        wall = perf_counter() - started
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+    return samples, wall
+
+
+##############################################################################
+# Gunicorn mode
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class HTTPSession:
+    """A logged-in HTTP client with its own cookie jar (not redirecting, so
+    only the route itself is timed)."""
+
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            self.NoRedirect())
+        self.csrf_token = None
+
+    def request(self, method, path, data=None):
+        """Return (status, body bytes, headers)."""
+
+        if data is not None:
+            data = urllib.parse.urlencode(data).encode()
+        elif method == 'POST':
+            data = b''
+
+        req = urllib.request.Request(self.base_url + path,
+                                     data=data,
+                                     method=method)
+        try:
+            with self.opener.open(req) as resp:
+                return resp.status, resp.read(), resp.headers
+        except urllib.error.HTTPError as error:
+            return error.code, error.read(), error.headers
+
+    def login(self, username, password):
+        """Log in through the form, keeping its CSRF token for later posts."""
+
+        _, body, _ = self.request('GET', '/login')
+        self.csrf_token = re.search(rb'name="csrf_token"[^>]*value="([^"]+)"',
+                                    body).group(1).decode()
+        status, _, _ = self.request('POST', '/login', {
+            'csrf_token': self.csrf_token,
+            'username': username,
+            'password': password,
+        })
+        if status != 302:
+            raise RuntimeError(f"login as {username} failed ({status})")
+
+
+def server_timing_queries(headers):
+    """The query count the app reported in its Server-Timing header."""
+
+    match = re.search(r'desc="(\d+) queries"', headers.get('Server-Timing', ''))
+    return int(match.group(1)) if match else None
+
+
+def start_gunicorn(database, workers):
+    """Start gunicorn on a free port; returns (process, base URL)."""
+
+    port = free_port()
+    env = dict(os.environ, DATABASE_URL=database, WEB_CONCURRENCY=str(workers))
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'app:app',
+         '--bind', f"127.0.0.1:{port}",
+         '--workers', str(workers),
+         '--threads', '4',
+         '--log-level', 'warning'],
+        cwd=HERE, env=env)
+    base_url = f"http://127.0.0.1:{port}"
+
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(base_url + '/login', timeout=1)
+            return process, base_url
+        except OSError:
+            time.sleep(0.1)
+
+    process.terminate()
+    raise RuntimeError("gunicorn didn't start")
+
+
+def run_gunicorn(targets, rounds, database, workers):
+    """Drive a real server over HTTP, one thread per item of `targets`."""
+
+    process, base_url = start_gunicorn(database, workers)
+    concurrency = len(targets)
+
+    try:
+        def run_thread(targets):
+            routes = scenarios(targets)
+            session = HTTPSession(base_url)
+            session.login(targets['viewer_username'], GENERATED_PASSWORD)
+
+            def send(route):
+                name, method, path, data = route
+                if data is not None:
+                    data = dict(data, csrf_token=session.csrf_token)
+                started = perf_counter()
+                status, _, headers = session.request(method, path, data)
+                return (perf_counter() - started, status,
+                        server_timing_queries(headers))
+
+            return run_rounds(routes, max(1, rounds // concurrency), send)
+
+        started = perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            per_thread = list(pool.map(run_thread, targets))
+        wall = perf_counter() - started
+
+    finally:
+        process.terminate()
+        process.wait()
+
+    samples = {}
+    for thread_samples in per_thread:
+        for name, values in thread_samples.items():
+            samples.setdefault(name, []).extend(values)
+
+    return samples, wall
+
+
+##############################################################################
+# Compression
+
+
+# (encoding, level) pairs to measure
+COMPRESSION_LEVELS = [('gzip', 1), ('gzip', 6), ('gzip', 9),
+                      ('br', 1), ('br', 4), ('br', 6), ('br', 11)]
+
+# pages to compress: the largest page of the feed and of the directory
+COMPRESSION_PAGES = [('home', '/?limit=100'), ('directory', '/users?limit=100')]
+
+
+def run_compression(targets, repeats):
+    """Time each compression level on each page; returns a list of rows."""
+
+    from app import app, CURR_USER_KEY
+    from compression import gzip_compress, brotli_compress
+
+    compressors = {'gzip': gzip_compress, 'br': brotli_compress}
+    client = app.test_client()
+
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = targets['viewer_id']
+
+    rows = []
+
+    for name, path in COMPRESSION_PAGES:
+        # no Accept-Encoding, so the app sends it uncompressed
+        body = client.get(path).get_data()
+
+        for encoding, level in COMPRESSION_LEVELS:
+            compress = compressors[encoding]
+            timings = []
+
+            for _ in range(repeats):
+                started = perf_counter()
+                compressed = compress(body, level)
+                timings.append(perf_counter() - started)
+
+            rows.append({
+                'page': name,
+                'encoding': encoding,
+                'level': level,
+                'bytes': len(body),
+                'compressed_bytes': len(compressed),
+                'saved_pct': round(100 * (1 - len(compressed) / len(body)), 1),
+                'ms': round(1000 * sorted(timings)[len(timings) // 2], 3),
+            })
+
+    return rows
+
+
+def print_compression(rows):
+    print(f"\n{'page':<10} {'encoding':<9} {'level':>5} {'bytes':>8} "
+          f"{'compressed':>10} {'saved':>6} {'ms':>7}")
+
+    for row in rows:
+        print(f"{row['page']:<10} {row['encoding']:<9} {row['level']:>5} "
+              f"{row['bytes']:>8} {row['compressed_bytes']:>10} "
+              f"{row['saved_pct']:>5}% {row['ms']:>7.3f}")
+
+
+##############################################################################
+# Reporting
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already-sorted list."""
+
+    index = max(0, -(-len(sorted_values) * pct // 100) - 1)
+    return sorted_values[int(index)]
+
+
+def summarize(samples, wall, concurrency=1):
+    """Turn raw samples into per-route statistics (times in ms)."""
+
+    results = {}
+
+    for name, values in samples.items():
+        times = sorted(seconds * 1000 for seconds, _, _ in values)
+        queries = [count for _, _, count in values if count is not None]
+        statuses = {}
+        for _, status, _ in values:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+        results[name] = {
+            'requests': len(values),
+            'p50_ms': round(percentile(times, 50), 3),
+            'p95_ms': round(percentile(times, 95), 3),
+            'p99_ms': round(percentile(times, 99), 3),
+            'mean_ms': round(sum(times) / len(times), 3),
+            # requests/second this route sustains with `concurrency` clients
+            'throughput_rps': round(
+                concurrency * 1000 * len(times) / sum(times), 1),
+            'queries_per_request': (round(sum(queries) / len(queries), 2)
+                                    if queries else None),
+            'statuses': statuses,
+        }
+
+    total = sum(len(values) for values in samples.values())
+    return {
+        'routes': results,
+        'total_requests': total,
+        'overall_rps': round(total / wall, 1),
+    }
+
+
+def print_table(mode, summary):
+    print(f"\n{mode}: {summary['total_requests']} requests, "
+          f"{summary['overall_rps']} req/s overall")
+    print(f"{'route':<10} {'p50':>8} {'p95':>8} {'p99':>8} {'rps':>8} "
+          f"{'queries':>8}  statuses")
+
+    for name, stats in summary['routes'].items():
+        queries = stats['queries_per_request']
+        print(f"{name:<10} {stats['p50_ms']:>8.2f} {stats['p95_ms']:>8.2f} "
+              f"{stats['p99_ms']:>8.2f} {stats['throughput_rps']:>8.1f} "
+              f"{'-' if queries is None else queries:>8}  "
+              f"{stats['statuses']}")
+
+
+def print_comparison(baseline, results):
+    """Show p50/p95 changes per route against an earlier run."""
+
+    print(f"\nchange vs {baseline['started_at']} (negative is faster):")
+
+    for mode, summary in results['modes'].items():
+        old_routes = baseline['modes'].get(mode, {}).get('routes', {})
+
+        for name, stats in summary['routes'].items():
+            old = old_routes.get(name)
+            if not old:
+                continue
+
+            changes = [
+                f"{key} {100 * (stats[key] - old[key]) / old[key]:+.1f}%"
+                for key in ('p50_ms', 'p95_ms') if old[key]
+            ]
+            print(f"  {mode:<9} {name:<10} {'  '.join(changes)}")
+
+
+def main():
+    args = parse_args()
+
+    # the app reads DATABASE_URL when it's imported
+    os.environ['DATABASE_URL'] = args.database
+    os.environ.setdefault('BCRYPT_WORKERS', '0')
+    sys.path.insert(0, HERE)
+    import app  # noqa: F401  (connects the models to the database)
+
+    if not args.skip_seed:
+        seed_dataset(args)
+
+    targets = pick_targets(args.concurrency)
+    results = {
+        'started_at': datetime.utcnow().isoformat(),
+        'dataset': {'users': args.users, 'messages': args.messages,
+                    'follows': args.follows, 'likes': args.likes,
+                    'seeded': not args.skip_seed},
+        'targets': targets[0],
+        'modes': {},
+    }
+
+    if args.mode in ('client', 'both'):
+        samples, wall = run_client(targets[0], args.requests)
+        results['modes']['client'] = summarize(samples, wall)
+
+    if args.mode in ('gunicorn', 'both'):
+        samples, wall = run_gunicorn(targets, args.requests, args.database,
+                                     args.workers)
+        results['modes']['gunicorn'] = summarize(samples, wall,
+                                                 args.concurrency)
+
+    if args.mode == 'compression':
+        results['compression'] = run_compression(targets[0], args.requests)
+        print_compression(results['compression'])
+
+    for mode, summary in results['modes'].items():
+        print_table(mode, summary)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            print_comparison(json.load(baseline), results)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
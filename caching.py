@@ -0,0 +1,136 @@
+"""In-process caches for Warbler.
+
+Each gunicorn worker has its own copy, so anything cached here can be stale
+in other workers until it expires; keep TTLs short.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class TTLCache:
+    """A small thread-safe mapping whose entries expire after `ttl` seconds.
+
+    Holds at most `maxsize` entries, dropping the oldest first. A `ttl` of 0
+    disables caching entirely.
+    """
+
+    def __init__(self, ttl, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """Return the cached value for `key`, or None if missing or expired."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return None
+
+            expires, value = entry
+
+            if expires <= monotonic():
+                del self._entries[key]
+                return None
+
+            return value
+
+    def set(self, key, value):
+        """Cache `value` under `key` for `ttl` seconds."""
+
+        if self.ttl <= 0:
+            return
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (monotonic() + self.ttl, value)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, *keys):
+        """Forget `keys` (missing keys are ignored)."""
+
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """Forget everything."""
+
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class LRUCache:
+    """A small thread-safe mapping capped by the total size of its values.
+
+    `sizeof(value)` gives each value's size (by default `len`, so characters
+    for strings); once the total passes `max_size`, the least recently used
+    entries are dropped. A `max_size` of 0 disables caching entirely.
+    """
+
+    def __init__(self, max_size, sizeof=len):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """Return the cached value for `key` (marking it used), or None."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return None
+
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        """Cache `value` under `key`; values bigger than the cap are skipped."""
+
+        size = self.sizeof(value)
+
+        if size > self.max_size:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[0]
+
+            self._entries[key] = (size, value)
+            self.size += size
+
+            while self.size > self.max_size:
+                _, (dropped, _) = self._entries.popitem(last=False)
+                self.size -= dropped
+
+    def pop(self, *keys):
+        """Forget `keys` (missing keys are ignored)."""
+
+        with self._lock:
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self.size -= entry[0]
+
+    def clear(self):
+        """Forget everything."""
+
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,164 @@
+"""Compression of dynamic responses.
+
+Pages are compressed with brotli or gzip, whichever the browser prefers of
+those it accepts (brotli only if the `brotli` package is installed).
+Responses smaller than COMPRESS_MIN_SIZE aren't worth it and go out as
+they are. Streamed responses are compressed as they're generated and
+flushed every STREAM_FLUSH_SIZE bytes, so the browser can still render
+them as they arrive.
+
+Files from send_file (/static/, /assets/) are left alone; the built assets
+are precompressed (see assets.py).
+
+Measured with `python benchmark.py --mode compression` (one core; KB
+after compression, and milliseconds of CPU per page):
+
+    page (uncompressed)     gzip 1      gzip 6      gzip 9      br 1        br 4        br 11
+    home, 100 msgs (101K)   11.4K 0.6   9.9K 1.2    9.8K 2.4    10.5K 0.2   9.4K 1.0    7.1K 188
+    /users, 100 (133K)      8.2K 0.4    7.4K 0.9    7.2K 2.4    7.3K 0.1    6.5K 0.5    5.4K 279
+
+Level 6 gzip and quality 4 brotli are the defaults. They save nearly as
+much as the highest levels, at a small fraction of the CPU. Brotli 11 is
+for assets built ahead of time, never for pages.
+"""
+
+import gzip
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # only gzip is offered
+    brotli = None
+
+# Streamed pages arrive in tiny pieces (a template tag at a time); flushing
+# each would ruin the compression, so output is flushed every this many
+# bytes of input instead
+STREAM_FLUSH_SIZE = 16 * 1024
+
+COMPRESSIBLE_MIMETYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/xml', 'text/javascript',
+    'application/javascript', 'application/json', 'image/svg+xml',
+}
+
+
+def gzip_compress(data, level):
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def brotli_compress(data, level):
+    return brotli.compress(data, quality=level)
+
+
+def gzip_stream(chunks, level):
+    """Gzip an iterable of byte strings, flushing whenever another
+    STREAM_FLUSH_SIZE bytes have gone in."""
+
+    # wbits 31: zlib's deflate with a gzip header and trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    pending = 0
+
+    for chunk in chunks:
+        output = compressor.compress(chunk)
+        pending += len(chunk)
+
+        if pending >= STREAM_FLUSH_SIZE:
+            output += compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+
+        if output:
+            yield output
+
+    yield compressor.flush()
+
+
+def brotli_stream(chunks, level):
+    """Brotli-compress an iterable of byte strings, flushing whenever
+    another STREAM_FLUSH_SIZE bytes have gone in."""
+
+    compressor = brotli.Compressor(quality=level)
+    pending = 0
+
+    for chunk in chunks:
+        output = compressor.process(chunk)
+        pending += len(chunk)
+
+        if pending >= STREAM_FLUSH_SIZE:
+            output += compressor.flush()
+            pending = 0
+
+        if output:
+            yield output
+
+    yield compressor.finish()
+
+
+class Compress:
+    """Compresses an app's responses.
+
+    Settings (app.config):
+
+    - COMPRESS_ENABLED: compress at all (default True)
+    - COMPRESS_MIN_SIZE: smallest body (bytes) worth compressing (default 500)
+    - COMPRESS_GZIP_LEVEL: 1 (fastest) to 9 (smallest), default 6
+    - COMPRESS_BROTLI_LEVEL: 0 (fastest) to 11 (smallest), default 4
+    """
+
+    def init_app(self, app):
+        if not app.config.setdefault('COMPRESS_ENABLED', True):
+            return
+
+        self.min_size = app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+        self.levels = {
+            'gzip': app.config.setdefault('COMPRESS_GZIP_LEVEL', 6),
+            'br': app.config.setdefault('COMPRESS_BROTLI_LEVEL', 4),
+        }
+
+        app.after_request(self.compress_response)
+
+    def choose_encoding(self):
+        """The encoding to use for this request, or None."""
+
+        offered = ['gzip'] if brotli is None else ['br', 'gzip']
+        return request.accept_encodings.best_match(offered)
+
+    def compress_response(self, response):
+        """Compress `response` if it's worth it and the browser accepts it."""
+
+        if (response.direct_passthrough
+                or response.status_code < 200
+                or response.status_code in (204, 304)
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+
+        # whether we compress or not, the body depends on Accept-Encoding
+        response.vary.add('Accept-Encoding')
+
+        if (not response.is_streamed
+                and response.calculate_content_length() < self.min_size):
+            return response
+
+        encoding = self.choose_encoding()
+        if encoding is None:
+            return response
+
+        level = self.levels[encoding]
+
+        if response.is_streamed:
+            stream = brotli_stream if encoding == 'br' else gzip_stream
+            response.response = stream(response.iter_encoded(), level)
+            response.headers.pop('Content-Length', None)
+        else:
+            compress = brotli_compress if encoding == 'br' else gzip_compress
+            response.set_data(compress(response.get_data(), level))
+
+        response.content_encoding = encoding
+
+        # a strong ETag promises identical bytes, which these aren't
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+
+        return response
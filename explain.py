@@ -0,0 +1,194 @@
+"""Query plan checks for the busiest pages.
+
+    flask check-plans
+
+Requests each page in `hot_pages` as a logged-in user, records the SELECTs
+it runs, and has Postgres EXPLAIN each one. Every full scan of one of the
+app's tables is reported, and the command fails, so a missing index shows
+up before the table is big enough for anyone to notice.
+
+The plans are made with sequential scans, hash joins and merge joins
+turned off, so that Postgres looks rows up by index whenever an index can
+serve the query, on a handful of test rows as on a full database (where it
+would make the same choice on cost). Without a usable index it either
+still scans the table sequentially, or reads a whole index whose leading
+column the query doesn't constrain (e.g. filtering follows by follower
+through a primary key that starts with the followed user). Both count as
+full scans; so does an index scan with no condition at all, unless a LIMIT
+stops it early (a first page in index order).
+
+Pages served from a read replica (see replicas.py) run their SELECTs there,
+so each one is explained on the database that ran it. Postgres only,
+replicas included.
+"""
+
+import json
+import re
+from collections import namedtuple
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+
+from models import db, Message, User
+
+FullScan = namedtuple('FullScan', 'url statement tables')
+
+INDEX_SCANS = ('Index Scan', 'Index Only Scan', 'Bitmap Index Scan')
+
+# planner methods turned off for the plans, since on small tables they beat
+# index lookups that large tables need
+PLANNER_SETTINGS = ('enable_seqscan', 'enable_hashjoin', 'enable_mergejoin')
+
+# nodes that read all their input before returning a row, so a LIMIT above
+# them doesn't cut short the scans below
+BLOCKING = ('Sort', 'Aggregate', 'Hash', 'SetOp', 'WindowAgg')
+
+
+def hot_pages(viewer, message, search):
+    """URLs of the pages worth checking, as seen by `viewer`."""
+
+    return [
+        '/',
+        f'/users/{viewer.id}',
+        f'/users/{viewer.id}/following',
+        f'/users/{viewer.id}/followers',
+        f'/users/{viewer.id}/liked_messages',
+        '/users',
+        f'/users?q={search}',
+        f'/messages/{message.id}',
+    ]
+
+
+def default_pages():
+    """`hot_pages` for the user following the most people, one of the
+    newest messages, and a search for the start of the viewer's name; None
+    without any users or messages."""
+
+    viewer = User.query.order_by(User.following_count.desc()).first()
+    message = Message.query.order_by(Message.id.desc()).first()
+
+    if viewer is None or message is None:
+        return None
+
+    return viewer, hot_pages(viewer, message, viewer.username[:3])
+
+
+def capture_selects(func):
+    """Call `func()`; returns the (engine, statement, parameters) of each
+    SELECT it ran, on the primary or a replica, in order, without repeats."""
+
+    selects = {}
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            key = (id(conn.engine),
+                   statement,
+                   json.dumps(parameters, default=str, sort_keys=True))
+            selects.setdefault(key, (conn.engine, statement, parameters))
+
+    # Engine, not db.engine: read-only pages may query a replica
+    event.listen(Engine, 'before_cursor_execute', record)
+    try:
+        func()
+    finally:
+        event.remove(Engine, 'before_cursor_execute', record)
+
+    return list(selects.values())
+
+
+def explain(statement, parameters, engine=None):
+    """The JSON plan of one statement on `engine` (default the primary),
+    made with index lookups preferred wherever possible."""
+
+    with (engine or db.engine).connect() as conn:
+        with conn.begin() as transaction:
+            for setting in PLANNER_SETTINGS:
+                conn.exec_driver_sql(f"SET LOCAL {setting} = off")
+            plan = conn.exec_driver_sql(
+                f"EXPLAIN (FORMAT JSON) {statement}", parameters).scalar()
+            transaction.rollback()
+
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    return plan[0]['Plan']
+
+
+def index_columns():
+    """The table and first column of every index on the app's tables, by
+    index name (the column is None for an index on an expression)."""
+
+    rows = db.session.execute(text(
+        "SELECT idx.relname, tbl.relname, attribute.attname "
+        "FROM pg_index "
+        "JOIN pg_class idx ON idx.oid = pg_index.indexrelid "
+        "JOIN pg_class tbl ON tbl.oid = pg_index.indrelid "
+        "LEFT JOIN pg_attribute attribute "
+        "  ON attribute.attrelid = pg_index.indrelid "
+        "  AND attribute.attnum = pg_index.indkey[0] "
+        "WHERE tbl.relname = ANY(:tables)"),
+        {'tables': list(db.metadata.tables)})
+
+    return {index: (table, column) for index, table, column in rows}
+
+
+def full_scans(plan, indexes, limited=False):
+    """Names of the app's tables that `plan`, or any plan under it, reads
+    in full.
+
+    `indexes` is what `index_columns` returns; `limited` is whether a LIMIT
+    above this plan stops it early.
+    """
+
+    found = []
+    node = plan.get('Node Type')
+    limited = (limited or node == 'Limit') and node not in BLOCKING
+
+    if node == 'Seq Scan' and plan['Relation Name'] in db.metadata.tables:
+        found.append(plan['Relation Name'])
+
+    elif node in INDEX_SCANS and plan['Index Name'] in indexes:
+        table, column = indexes[plan['Index Name']]
+        condition = plan.get('Index Cond')
+
+        if condition is None:
+            full = not limited
+        else:
+            full = (column is not None
+                    and not re.search(rf'\b{column}\b', condition))
+
+        if full:
+            found.append(table)
+
+    for child in plan.get('Plans', ()):
+        found.extend(full_scans(child, indexes, limited))
+
+    return found
+
+
+def check_pages(app, urls, session=None):
+    """Request `urls` with `session` set, and return a `FullScan` for every
+    query that reads one of the app's tables (or indexes) in full."""
+
+    client = app.test_client()
+    if session:
+        with client.session_transaction() as sess:
+            sess.update(session)
+
+    indexes = index_columns()
+    scans = []
+
+    for url in urls:
+        def get():
+            response = client.get(url)
+            response.close()
+            if response.status_code != 200:
+                raise RuntimeError(f"{url} answered {response.status_code}")
+
+        for engine, statement, parameters in capture_selects(get):
+            plan = explain(statement, parameters, engine)
+            scanned = full_scans(plan, indexes)
+            if scanned:
+                scans.append(FullScan(url, statement, sorted(set(scanned))))
+
+    return scans
@@ -2,29 +2,59 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows:
+
+    python generator/create_csvs.py --users 1000000 --messages 20000000 \\
+        --follows 50000000 --likes 10000000 --processes 8
+
+Everything is generated locally (no network calls), and the same --seed
+always produces the same files: message timestamps fall in the two years
+before --now, a fixed date unless given, rather than before today. Work is split into ranges of user/message
+ids, each written to a part file by a pool of processes and then joined.
+
+Follows and likes are sampled per follower (or liker) without ever building
+the list of all possible pairs, so memory stays proportional to the number
+of users, not its square. Who gets followed follows a power law (--zipf):
+a few accounts collect most of the followers, like the real thing.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import random
+import shutil
+from datetime import datetime
+from multiprocessing import Pool
+
 from faker import Faker
-from helpers import get_random_datetime
+
+from helpers import get_random_datetime, split_range, PowerLawSampler
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['message_id', 'users_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
+NUM_LIKES = 0
+
+# bcrypt hash of "password", shared by every generated user
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+# default end of the message timestamp range; fixed, so a seed always gives
+# the same files
+DEFAULT_NOW = '2026-01-01T00:00:00'
+
+# rows per unit of work handed to the pool
+ROWS_PER_TASK = 20000
 
-fake = Faker()
+GENERATOR_DIR = os.path.dirname(os.path.abspath(__file__))
 
-# Generate random profile image URLs to use for users
+# Random profile image URLs to use for users
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +62,229 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# Header image URLs to use for users (collected once from splashbase, so
+# generating data needs no network access)
+
+with open(os.path.join(GENERATOR_DIR, 'header_images.txt')) as header_images:
+    header_image_urls = header_images.read().split()
+
+
+def task_rng(seed, kind, index):
+    """A random number generator unique to one unit of work."""
+
+    return random.Random(f"{seed}-{kind}-{index}")
+
+
+def task_faker(rng):
+    """A Faker seeded from `rng`."""
+
+    fake = Faker()
+    fake.seed_instance(rng.getrandbits(64))
+    return fake
+
+
+def write_users(writer, start, stop, rng):
+    """Users with ids start..stop-1; ids are made part of the username and
+    email so they stay unique at any size."""
+
+    fake = task_faker(rng)
+
+    for user_id in range(start, stop):
+        username = f"{fake.user_name()}{user_id}"
+        writer.writerow([
+            f"{username}@{fake.free_email_domain()}",
+            username,
+            rng.choice(image_urls),
+            PASSWORD_HASH,
+            fake.sentence(),
+            rng.choice(header_image_urls),
+            fake.city(),
+        ])
+
+
+def write_messages(writer, start, stop, rng, num_users, now):
+    """Messages with ids start..stop-1, by random users, posted in the
+    two years before `now`."""
+
+    fake = task_faker(rng)
+
+    for _ in range(start, stop):
+        writer.writerow([
+            fake.paragraph()[:MAX_WARBLER_LENGTH],
+            get_random_datetime(rng=rng, now=now),
+            rng.randint(1, num_users),
+        ])
+
+
+def sample_edges(rng, start, stop, budget, draw_target, max_degree, exclude_self):
+    """Yield (source, target) pairs for sources start..stop-1.
+
+    `budget` edges are spread at random over the sources; each source's
+    targets are drawn with `draw_target(rng)` and de-duplicated, so only one
+    source's targets are held in memory at a time.
+    """
+
+    degrees = [0] * (stop - start)
+    for _ in range(budget):
+        degrees[rng.randrange(stop - start)] += 1
+
+    for offset, degree in enumerate(degrees):
+        source = start + offset
+        targets = set()
+
+        for _ in range(min(degree, max_degree)):
+            # rejection sampling; fine while degree is far below max_degree
+            while True:
+                target = draw_target(rng)
+                if target not in targets and not (exclude_self and target == source):
+                    break
+            targets.add(target)
+
+        for target in targets:
+            yield source, target
+
+
+def write_follows(writer, start, stop, rng, budget, num_users, zipf, seed):
+    """Follows made by users start..stop-1, popular users followed more."""
+
+    followed = PowerLawSampler(num_users, zipf, seed)
+
+    for follower, followed_user in sample_edges(rng, start, stop, budget,
+                                                followed.draw,
+                                                num_users - 1,
+                                                exclude_self=True):
+        writer.writerow([followed_user, follower])
+
+
+def write_likes(writer, start, stop, rng, budget, num_messages):
+    """Likes made by users start..stop-1, on random messages."""
+
+    for liker, message_id in sample_edges(rng, start, stop, budget,
+                                          lambda rng: rng.randint(1, num_messages),
+                                          num_messages,
+                                          exclude_self=False):
+        writer.writerow([message_id, liker])
+
+
+def run_task(task):
+    """Write one part file; `task` is (kind, index, part_path, start, stop,
+    extra args...)."""
+
+    kind, index, part_path, start, stop, *args = task
+    seed = args[-1]
+    rng = task_rng(seed, kind, index)
+
+    with open(part_path, 'w', newline='') as part:
+        writer = csv.writer(part)
+
+        if kind == 'users':
+            write_users(writer, start, stop, rng)
+        elif kind == 'messages':
+            num_users, now, seed = args
+            write_messages(writer, start, stop, rng, num_users, now)
+        elif kind == 'follows':
+            budget, num_users, zipf, seed = args
+            write_follows(writer, start, stop, rng, budget, num_users, zipf, seed)
+        elif kind == 'likes':
+            budget, num_messages, seed = args
+            write_likes(writer, start, stop, rng, budget, num_messages)
+
+    return part_path
+
+
+def plan_tasks(args, parts_dir):
+    """Split the work into tasks; returns {kind: [task, ...]}."""
+
+    def ranges(count):
+        parts = max(1, -(-count // ROWS_PER_TASK))
+        return split_range(1, count + 1, parts)
+
+    def edge_tasks(kind, total, *extra):
+        # share the edges among the user ranges in proportion to their size
+        user_ranges = ranges(args.users)
+        budgets = [total * (stop - start) // args.users
+                   for start, stop in user_ranges]
+        budgets[0] += total - sum(budgets)
+
+        return [(kind, i, part_path(kind, i), start, stop, budget, *extra)
+                for i, ((start, stop), budget)
+                in enumerate(zip(user_ranges, budgets))]
+
+    def part_path(kind, index):
+        return os.path.join(parts_dir, f"{kind}-{index:05d}.csv")
+
+    tasks = {
+        'users': [('users', i, part_path('users', i), start, stop, args.seed)
+                  for i, (start, stop) in enumerate(ranges(args.users))],
+        'messages': [('messages', i, part_path('messages', i), start, stop,
+                      args.users, args.now, args.seed)
+                     for i, (start, stop) in enumerate(ranges(args.messages))],
+        'follows': edge_tasks('follows', args.follows,
+                              args.users, args.zipf, args.seed),
+    }
+
+    if args.likes:
+        tasks['likes'] = edge_tasks('likes', args.likes,
+                                    args.messages, args.seed)
+
+    return tasks
+
+
+HEADERS = {
+    'users': USERS_CSV_HEADERS,
+    'messages': MESSAGES_CSV_HEADERS,
+    'follows': FOLLOWS_CSV_HEADERS,
+    'likes': LIKES_CSV_HEADERS,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate Warbler CSV fixtures.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS)
+    parser.add_argument('--likes', type=int, default=NUM_LIKES)
+    parser.add_argument('--zipf', type=float, default=1.0,
+                        help="power-law exponent for who gets followed "
+                             "(0 = uniform)")
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--now', type=datetime.fromisoformat,
+                        default=DEFAULT_NOW,
+                        help="end of the message timestamp range "
+                             f"(ISO format, default {DEFAULT_NOW})")
+    parser.add_argument('--out', default=GENERATOR_DIR,
+                        help="directory for the CSV files")
+    args = parser.parse_args()
+
+    if args.follows > args.users * (args.users - 1):
+        parser.error("more follows than there are pairs of users")
+    if args.likes > args.users * args.messages:
+        parser.error("more likes than there are (user, message) pairs")
+
+    parts_dir = os.path.join(args.out, '.parts')
+    os.makedirs(parts_dir, exist_ok=True)
+
+    tasks = plan_tasks(args, parts_dir)
+    all_tasks = [task for kind_tasks in tasks.values() for task in kind_tasks]
+
+    with Pool(args.processes) as pool:
+        for _ in pool.imap_unordered(run_task, all_tasks):
+            pass
+
+    # join the parts, in id order, under a header
+    for kind, kind_tasks in tasks.items():
+        with open(os.path.join(args.out, f"{kind}.csv"), 'w', newline='') as out:
+            csv.writer(out).writerow(HEADERS[kind])
+
+            for task in kind_tasks:
+                with open(task[2], newline='') as part:
+                    shutil.copyfileobj(part, out)
+                os.remove(task[2])
+
+    os.rmdir(parts_dir)
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
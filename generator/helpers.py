@@ -1,14 +1,64 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import random
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from itertools import accumulate
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(year_gap=2, rng=random, now=None):
+    """Get a random datetime within the `year_gap` years before `now`
+    (default: the current time)."""
 
-    now = datetime.now()
+    if now is None:
+        now = datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    seconds = rng.uniform(0, (now - then).total_seconds())
 
-    return datetime.fromtimestamp(random_timestamp)
+    return then + timedelta(seconds=seconds)
+
+
+def split_range(start, stop, parts):
+    """Split range(start, stop) into `parts` contiguous (start, stop) pairs
+    of nearly equal size (empty ones are dropped)."""
+
+    size, extra = divmod(stop - start, parts)
+    bounds = []
+
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        if end > start:
+            bounds.append((start, end))
+        start = end
+
+    return bounds
+
+
+class PowerLawSampler:
+    """Draw ids 1..n where the k-th most popular id is picked with weight
+    1 / k**exponent (exponent 0 is uniform).
+
+    Popularity ranks are shuffled with `seed`, so the hubs aren't simply the
+    lowest ids, and every process building a sampler with the same arguments
+    gets the same distribution. Memory is O(n); drawing is O(log n).
+    """
+
+    def __init__(self, n, exponent, seed):
+        self.n = n
+        self.uniform = exponent == 0
+
+        if not self.uniform:
+            ids = list(range(1, n + 1))
+            random.Random(seed).shuffle(ids)
+            self.ids = ids
+            self.cum_weights = list(accumulate(
+                1 / rank ** exponent for rank in range(1, n + 1)))
+
+    def draw(self, rng):
+        """Return one id."""
+
+        if self.uniform:
+            return rng.randint(1, self.n)
+
+        point = rng.random() * self.cum_weights[-1]
+        return self.ids[bisect_right(self.cum_weights, point)]
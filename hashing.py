@@ -0,0 +1,125 @@
+"""Password hashing for Warbler.
+
+bcrypt is deliberately slow (~250ms at cost 12), so hashing runs in a small
+pool of worker processes rather than on the web worker's own CPU time. With
+threaded gunicorn workers (see Procfile), a login waits on the pool while
+the worker's other threads go on serving pages; the host's CPUs are shared
+out between the web workers' pools rather than each taking them all. The
+number of hashes waiting for the pool is bounded: past that, callers get
+`HashingBusy` (a 503) instead of piling up behind each other.
+"""
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from threading import BoundedSemaphore, Lock
+
+import bcrypt
+
+
+class HashingBusy(Exception):
+    """Raised when too many password hashes are already waiting."""
+
+
+def _hash_password(password, rounds):
+    """Hash `password` with a fresh salt (runs in a pool process)."""
+
+    salt = bcrypt.gensalt(rounds)
+    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+
+
+def _check_password(hashed, password):
+    """Does `password` match `hashed`? (runs in a pool process)"""
+
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    except ValueError:
+        # not a bcrypt hash at all
+        return False
+
+
+class PasswordHasher:
+    """Hashes and checks passwords in a bounded process pool.
+
+    Configured from the app with `init_app`:
+
+    - BCRYPT_LOG_ROUNDS: bcrypt cost factor for new hashes (default 12)
+    - BCRYPT_WORKERS: pool processes per web worker; 0 hashes inline
+      (default: the CPU count divided by WEB_CONCURRENCY, at least 1)
+    - WEB_CONCURRENCY: web worker processes on this host (default 1)
+    - BCRYPT_MAX_PENDING: hashes allowed to queue for the pool
+      (default: 4 per process)
+    - BCRYPT_QUEUE_TIMEOUT: seconds to wait for a queue slot before raising
+      HashingBusy (default 2)
+    """
+
+    def __init__(self):
+        self.rounds = 12
+        self.workers = 0
+        self.queue_timeout = 2
+        self._slots = None
+        self._pool = None
+        self._pool_lock = Lock()
+
+    def init_app(self, app):
+        """Read settings from `app.config`."""
+
+        web_workers = app.config.setdefault('WEB_CONCURRENCY', 1)
+        workers = max(1, (os.cpu_count() or 1) // max(web_workers, 1))
+
+        self.rounds = app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+        self.workers = app.config.setdefault('BCRYPT_WORKERS', workers)
+        max_pending = app.config.setdefault('BCRYPT_MAX_PENDING',
+                                            4 * max(self.workers, 1))
+        self.queue_timeout = app.config.setdefault('BCRYPT_QUEUE_TIMEOUT', 2)
+        self._slots = BoundedSemaphore(max_pending)
+
+    def hash(self, password):
+        """Return a bcrypt hash of `password` at the configured cost."""
+
+        return self._run(_hash_password, password, self.rounds)
+
+    def check(self, hashed, password):
+        """Does `password` match the stored hash `hashed`?"""
+
+        return self._run(_check_password, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different cost than the configured one?"""
+
+        # bcrypt hashes look like $2b$12$<salt and hash>
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def _run(self, func, *args):
+        """Run `func(*args)` in the pool, or inline if there's no pool."""
+
+        if not self.workers:
+            return func(*args)
+
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise HashingBusy()
+
+        try:
+            return self._get_pool().submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def _get_pool(self):
+        """Start the pool on first use, so each (forked) web worker gets its
+        own processes.
+
+        By then the web worker runs other threads (the invalidation
+        listener, the like buffer), so pool processes come from a fork
+        server instead of a fork of this process.
+        """
+
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('forkserver'))
+
+            return self._pool
@@ -0,0 +1,210 @@
+"""Cache invalidation across workers.
+
+Each gunicorn worker has its own in-process caches (see caching.py). A
+request that changes something cached publishes an event naming what
+changed; once its transaction commits, every worker, this one included,
+drops the matching entries.
+
+- `PostgresBus` sends events with NOTIFY, which Postgres delivers only if
+  and when the transaction commits. Each worker has a thread LISTENing for
+  them.
+- `MemoryBus` only reaches the current process: for tests, and for
+  single-process setups such as SQLite development databases.
+"""
+
+import json
+import logging
+import os
+import select
+import threading
+import time
+import uuid
+
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+CHANNEL = 'warbler_invalidate'
+
+# keys per NOTIFY; a payload must stay under Postgres' 8000 bytes
+KEYS_PER_NOTIFY = 500
+
+# how long the listener waits for events before checking its connection
+POLL_SECONDS = 5
+
+# how long the listener waits before reconnecting after an error
+RECONNECT_SECONDS = 1
+
+PENDING_KEY = 'invalidation_pending'
+
+
+class MemoryBus:
+    """Delivers invalidation events to this process when the session that
+    published them commits (and drops them if it rolls back)."""
+
+    def __init__(self, db):
+        self.db = db
+        self._handlers = {}
+
+        event.listen(db.session, 'after_commit', self._after_commit)
+        event.listen(db.session, 'after_soft_rollback', self._after_rollback)
+
+    def subscribe(self, kind, evict, clear):
+        """Call `evict(*keys)` for events about `kind`, and `clear()` when
+        every key of that kind may have changed."""
+
+        self._handlers.setdefault(kind, []).append((evict, clear))
+
+    def publish(self, kind, keys=None):
+        """Announce that `keys` of `kind` (None: all of them) change in the
+        current transaction."""
+
+        keys = None if keys is None else list(keys)
+        pending = self.db.session().info.setdefault(PENDING_KEY, [])
+        pending.append((kind, keys))
+
+    def dispatch(self, kind, keys):
+        """Evict `keys` of `kind` from this process's caches."""
+
+        for evict, clear in self._handlers.get(kind, ()):
+            if keys is None:
+                clear()
+            else:
+                evict(*keys)
+
+    def clear_all(self):
+        """Empty every subscribed cache."""
+
+        for handlers in self._handlers.values():
+            for _, clear in handlers:
+                clear()
+
+    def start(self):
+        """Nothing to listen for in memory."""
+
+    def _after_commit(self, session):
+        for kind, keys in session.info.pop(PENDING_KEY, ()):
+            self.dispatch(kind, keys)
+
+    def _after_rollback(self, session, previous_transaction):
+        if not session.in_transaction():
+            session.info.pop(PENDING_KEY, None)
+
+
+class PostgresBus(MemoryBus):
+    """Also NOTIFYs other workers, and listens for their NOTIFYs on a
+    thread of its own.
+
+    Events sent while the listener isn't connected (before it first
+    connects, or after its connection drops) are missed, so every subscribed
+    cache is cleared each time it connects.
+    """
+
+    def __init__(self, db):
+        super().__init__(db)
+        self._pid = None
+        self._origin = None
+
+    def publish(self, kind, keys=None):
+        """Announce the change here, and NOTIFY the other workers as part of
+        the current transaction."""
+
+        super().publish(kind, keys)
+        self.start()
+
+        chunks = [None] if keys is None else _chunks(list(keys), KEYS_PER_NOTIFY)
+
+        for chunk in chunks:
+            payload = json.dumps({'origin': self._origin,
+                                  'kind': kind,
+                                  'keys': chunk})
+            self.db.session.execute(
+                self.db.select(self.db.func.pg_notify(CHANNEL, payload)))
+
+    def start(self):
+        """Start this process's listener thread, once per process (so it
+        works after gunicorn forks)."""
+
+        if self._pid == os.getpid():
+            return
+
+        self._pid = os.getpid()
+        self._origin = uuid.uuid4().hex
+        self._connected = threading.Event()
+
+        thread = threading.Thread(target=self._listen,
+                                  name='invalidation-listener',
+                                  daemon=True)
+        thread.start()
+
+    def _listen(self):
+        """Receive events until the process exits."""
+
+        while True:
+            try:
+                connection = self._connect()
+            except Exception:
+                log.exception("can't listen for cache invalidations")
+                time.sleep(RECONNECT_SECONDS)
+                continue
+
+            self.clear_all()
+            self._connected.set()
+
+            try:
+                self._receive(connection)
+            except Exception:
+                log.exception("lost the cache invalidation connection")
+                self._connected.clear()
+                time.sleep(RECONNECT_SECONDS)
+            finally:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+
+    def _connect(self):
+        """A psycopg2 connection of its own, out of the pool, LISTENing."""
+
+        fairy = self.db.engine.raw_connection()
+        fairy.detach()
+        connection = fairy.connection
+        connection.autocommit = True
+        connection.cursor().execute(f"LISTEN {CHANNEL}")
+        return connection
+
+    def _receive(self, connection):
+        while True:
+            readable, _, _ = select.select([connection], [], [], POLL_SECONDS)
+
+            if not readable:
+                # nothing for a while; make sure the connection is still up
+                connection.cursor().execute("SELECT 1")
+                continue
+
+            connection.poll()
+
+            while connection.notifies:
+                notify = connection.notifies.pop(0)
+                message = json.loads(notify.payload)
+
+                # this worker's own events were handled when they committed
+                if message['origin'] != self._origin:
+                    self.dispatch(message['kind'], message['keys'])
+
+    def wait_until_listening(self, timeout=None):
+        """Block until the listener is connected; True if it is."""
+
+        self.start()
+        return self._connected.wait(timeout)
+
+
+def create_bus(kind, db):
+    """The bus named by INVALIDATION_BUS: 'postgres' or 'memory'."""
+
+    buses = {'postgres': PostgresBus, 'memory': MemoryBus}
+    return buses[kind](db)
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
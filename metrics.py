@@ -0,0 +1,289 @@
+"""Per-request timings and counters for Warbler.
+
+Every request records how many SQL statements it ran and how long they took,
+how long its templates took to render, its total time and its response size.
+The totals are kept per endpoint and can be served as Prometheus text (at
+METRICS_PATH, to scrapers that present METRICS_TOKEN or connect from
+METRICS_ALLOWED_IPS); each response also reports its own numbers in a
+Server-Timing header, which shows up in the browser's network panel.
+
+Counters live in the memory of each worker process, so with several gunicorn
+workers the endpoint shows whichever worker answered the scrape (the `pid`
+label tells them apart). Streamed responses are measured up to the point the
+body starts streaming.
+"""
+
+import hmac
+import ipaddress
+import os
+from threading import Lock
+from time import perf_counter
+
+from flask import (Response, abort, g, has_request_context, request,
+                   request_started, request_finished, before_render_template,
+                   template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class RequestTimings:
+    """What one request has done so far; kept on `g.request_timings`."""
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.render_seconds = 0.0
+        self.render_started = []
+
+    def server_timing(self, total_seconds):
+        """The value of this request's Server-Timing header."""
+
+        return (f'db;dur={self.db_seconds * 1000:.1f};desc="{self.queries} queries", '
+                f'render;dur={self.render_seconds * 1000:.1f}, '
+                f'total;dur={total_seconds * 1000:.1f}')
+
+
+class EndpointStats:
+    """Running totals for every request to one endpoint."""
+
+    def __init__(self):
+        self.statuses = {}
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.requests = 0
+        self.seconds = 0.0
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.render_seconds = 0.0
+        self.response_bytes = 0
+
+    def add(self, timings, total_seconds, status, size):
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.requests += 1
+        self.seconds += total_seconds
+        self.queries += timings.queries
+        self.db_seconds += timings.db_seconds
+        self.render_seconds += timings.render_seconds
+        self.response_bytes += size
+
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if total_seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+
+class Metrics:
+    """Collects request metrics for an app and serves them to Prometheus.
+
+    Settings (app.config):
+
+    - METRICS_ENABLED: record anything at all (default True)
+    - METRICS_SERVER_TIMING: add the Server-Timing header (default True)
+    - METRICS_PATH: URL of the Prometheus endpoint, or None for no endpoint
+      (default None)
+    - METRICS_TOKEN: a scrape sending `Authorization: Bearer <token>` may
+      read the endpoint (default None)
+    - METRICS_ALLOWED_IPS: client addresses or networks (e.g. '10.0.0.0/8')
+      that may read it without the token (default none)
+
+    An endpoint needs a token, allowed addresses or both; anyone else gets
+    a 403.
+    """
+
+    def __init__(self):
+        self.endpoints = {}
+        self._lock = Lock()
+
+    def init_app(self, app):
+        if not app.config.setdefault('METRICS_ENABLED', True):
+            return
+
+        self.server_timing = app.config.setdefault('METRICS_SERVER_TIMING', True)
+        path = app.config.setdefault('METRICS_PATH', None)
+        self.token = app.config.setdefault('METRICS_TOKEN', None)
+        self.allowed_networks = [
+            ipaddress.ip_network(address, strict=False)
+            for address in app.config.setdefault('METRICS_ALLOWED_IPS', [])]
+
+        if path and not (self.token or self.allowed_networks):
+            raise RuntimeError(
+                'METRICS_PATH needs METRICS_TOKEN or METRICS_ALLOWED_IPS')
+
+        # Engine, not one engine: covers every database the app talks to.
+        # The listeners serve every app, so they're added once per process.
+        if not event.contains(Engine, 'before_cursor_execute', _query_started):
+            event.listen(Engine, 'before_cursor_execute', _query_started)
+            event.listen(Engine, 'after_cursor_execute', _query_finished)
+            event.listen(Engine, 'handle_error', _query_failed)
+
+        request_started.connect(_request_started, app)
+        before_render_template.connect(_render_started, app)
+        template_rendered.connect(_render_finished, app)
+        request_finished.connect(self._request_finished, app)
+
+        if path:
+            app.add_url_rule(path, 'metrics', self.metrics_view)
+
+    def _request_finished(self, sender, response, **extra):
+        """Add this request to its endpoint's totals and set Server-Timing."""
+
+        timings = g.pop('request_timings', None)
+        if timings is None:
+            return
+
+        total_seconds = perf_counter() - timings.started
+        # asking a streamed response its length would buffer it
+        if response.is_streamed:
+            size = 0
+        else:
+            size = response.calculate_content_length() or 0
+        endpoint = request.endpoint or 'unmatched'
+
+        with self._lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = EndpointStats()
+            stats.add(timings, total_seconds, response.status_code, size)
+
+        if self.server_timing:
+            response.headers['Server-Timing'] = timings.server_timing(total_seconds)
+
+    def metrics_view(self):
+        """Serve the totals in the Prometheus text format, to allowed
+        scrapers."""
+
+        if not self.may_scrape():
+            abort(403)
+
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+    def may_scrape(self):
+        """Does this request carry the token, or come from an allowed
+        address?"""
+
+        if self.allowed_networks and request.remote_addr:
+            address = ipaddress.ip_address(request.remote_addr)
+            if any(address in network for network in self.allowed_networks):
+                return True
+
+        if self.token:
+            supplied = request.headers.get('Authorization', '')
+            return hmac.compare_digest(supplied.encode(),
+                                       f'Bearer {self.token}'.encode())
+
+        return False
+
+    def render(self):
+        """The totals in the Prometheus text exposition format."""
+
+        pid = os.getpid()
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+
+            family('warbler_http_requests_total', 'counter',
+                   'Requests handled, by endpoint and status.')
+            for endpoint, stats in endpoints:
+                for status, count in sorted(stats.statuses.items()):
+                    lines.append(
+                        f'warbler_http_requests_total{{pid="{pid}",'
+                        f'endpoint="{endpoint}",status="{status}"}} {count}')
+
+            family('warbler_http_request_duration_seconds', 'histogram',
+                   'Time to handle a request.')
+            for endpoint, stats in endpoints:
+                labels = f'pid="{pid}",endpoint="{endpoint}"'
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                    cumulative += count
+                    lines.append(
+                        f'warbler_http_request_duration_seconds_bucket'
+                        f'{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(
+                    f'warbler_http_request_duration_seconds_bucket'
+                    f'{{{labels},le="+Inf"}} {stats.requests}')
+                lines.append(
+                    f'warbler_http_request_duration_seconds_sum'
+                    f'{{{labels}}} {stats.seconds:.6f}')
+                lines.append(
+                    f'warbler_http_request_duration_seconds_count'
+                    f'{{{labels}}} {stats.requests}')
+
+            totals = [
+                ('warbler_db_queries_total', 'queries',
+                 'SQL statements run.', '{}'),
+                ('warbler_db_duration_seconds_total', 'db_seconds',
+                 'Time spent running SQL statements.', '{:.6f}'),
+                ('warbler_template_render_seconds_total', 'render_seconds',
+                 'Time spent rendering templates.', '{:.6f}'),
+                ('warbler_http_response_bytes_total', 'response_bytes',
+                 'Response body bytes sent (where the size is known).', '{}'),
+            ]
+            for name, attr, help_text, number in totals:
+                family(name, 'counter', f"{help_text[:-1]}, by endpoint.")
+                for endpoint, stats in endpoints:
+                    value = number.format(getattr(stats, attr))
+                    lines.append(
+                        f'{name}{{pid="{pid}",endpoint="{endpoint}"}} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """Forget all totals."""
+
+        with self._lock:
+            self.endpoints.clear()
+
+
+def current_timings():
+    """This request's `RequestTimings`, or None outside a measured request."""
+
+    if has_request_context():
+        return g.get('request_timings')
+
+    return None
+
+
+def _request_started(sender, **extra):
+    g.request_timings = RequestTimings()
+
+
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(perf_counter())
+
+
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    timings = current_timings()
+
+    if timings is not None:
+        timings.queries += 1
+        timings.db_seconds += perf_counter() - started
+
+
+def _query_failed(context):
+    # after_cursor_execute never comes for a statement that raised
+    if context.connection is not None:
+        context.connection.info.get('query_started', [None]).pop()
+
+
+def _render_started(sender, template, context, **extra):
+    timings = current_timings()
+
+    if timings is not None:
+        timings.render_started.append(perf_counter())
+
+
+def _render_finished(sender, template, context, **extra):
+    timings = current_timings()
+
+    if timings is not None and timings.render_started:
+        timings.render_seconds += perf_counter() - timings.render_started.pop()
@@ -0,0 +1,111 @@
+"""counter columns, timelines and username search indexes
+
+Adds what the models gained after the baseline:
+
+- users' messages, following, followers and likes counts, and the
+  updated_at row version
+- timeline_entries, the fan-out-on-write home timelines
+- ON DELETE CASCADE on the likes foreign keys
+- the username prefix (text_pattern_ops) and trigram indexes
+
+The counts and timelines are then filled in from the existing rows, as
+`User.reconcile_counts` and `TimelineEntry.rebuild` would. updated_at stays
+NULL until each user's next change.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 04:08:58.479918
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from models import TRIGRAM_INDEX, create_trigram_index
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+# (counter column, table, user id column)
+COUNTS = [
+    ('messages_count', 'messages', 'user_id'),
+    ('following_count', 'follows', 'user_following_id'),
+    ('followers_count', 'follows', 'user_being_followed_id'),
+    ('likes_count', 'likes', 'users_id'),
+]
+
+# (foreign key, column, referenced table)
+LIKE_KEYS = [
+    ('likes_message_id_fkey', 'message_id', 'messages'),
+    ('likes_users_id_fkey', 'users_id', 'users'),
+]
+
+# names Postgres gives unnamed foreign keys, so that SQLite's (reflected
+# without names) can be dropped by the same ones
+NAMING = {'fk': '%(table_name)s_%(column_0_name)s_fkey'}
+
+
+def upgrade():
+    for counter, _, _ in COUNTS:
+        op.add_column('users', sa.Column(counter, sa.Integer(), server_default='0', nullable=False))
+    op.add_column('users', sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+    op.create_table('timeline_entries',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('message_id', sa.Integer(), nullable=False),
+    sa.Column('author_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['author_id'], ['users.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['message_id'], ['messages.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id', 'message_id')
+    )
+    op.create_index('ix_timeline_entries_user_id_timestamp', 'timeline_entries', ['user_id', 'timestamp', 'message_id'], unique=False)
+
+    with op.batch_alter_table('likes', naming_convention=NAMING) as batch_op:
+        for name, column, table in LIKE_KEYS:
+            batch_op.drop_constraint(name, type_='foreignkey')
+            batch_op.create_foreign_key(name, table, [column], ['id'], ondelete='cascade')
+
+    op.create_index('ix_users_username_pattern', 'users', ['username'], unique=False, postgresql_ops={'username': 'text_pattern_ops'})
+    create_trigram_index(op.get_bind())
+
+    # one GROUP BY per counter, rather than a count per user
+    for counter, table, user_id in COUNTS:
+        op.execute(f"UPDATE users SET {counter} = counts.total "
+                   f"FROM (SELECT {user_id} AS user_id, count(*) AS total "
+                   f"      FROM {table} GROUP BY {user_id}) AS counts "
+                   "WHERE counts.user_id = users.id")
+
+    # each user's own messages, then those of everyone they follow
+    op.execute("INSERT INTO timeline_entries "
+               "(user_id, message_id, author_id, timestamp) "
+               "SELECT user_id, id, user_id, timestamp FROM messages")
+    op.execute("INSERT INTO timeline_entries "
+               "(user_id, message_id, author_id, timestamp) "
+               "SELECT follows.user_following_id, messages.id, "
+               "       messages.user_id, messages.timestamp "
+               "FROM messages JOIN follows "
+               "  ON follows.user_being_followed_id = messages.user_id "
+               "WHERE follows.user_following_id != messages.user_id")
+
+
+def downgrade():
+    op.execute(f"DROP INDEX IF EXISTS {TRIGRAM_INDEX}")
+    op.drop_index('ix_users_username_pattern', table_name='users', postgresql_ops={'username': 'text_pattern_ops'})
+
+    with op.batch_alter_table('likes', naming_convention=NAMING) as batch_op:
+        for name, column, table in LIKE_KEYS:
+            batch_op.drop_constraint(name, type_='foreignkey')
+            batch_op.create_foreign_key(name, table, [column], ['id'])
+
+    op.drop_index('ix_timeline_entries_user_id_timestamp', table_name='timeline_entries')
+    op.drop_table('timeline_entries')
+
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('updated_at')
+        for counter, _, _ in reversed(COUNTS):
+            batch_op.drop_column(counter)
@@ -0,0 +1,56 @@
+"""indexes for the feed, follow and like lookups
+
+The primary keys of follows and likes lead with the followed user and the
+message, so "who does this user follow" and "what has this user liked" had
+no index to use, nor did a user's messages newest-first before
+ix_messages_user_id_timestamp was declared.
+
+On Postgres the indexes are built CONCURRENTLY, outside the migration's
+transaction, so the tables stay writable while they build. IF NOT EXISTS
+covers databases that already have them from `db.create_all()`; if a
+concurrent build fails it leaves an INVALID index behind, which has to be
+dropped before running this again.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 04:02:37.118204
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+# (name, table, columns)
+INDEXES = [
+    ('ix_messages_user_id_timestamp', 'messages', ['user_id', 'timestamp', 'id']),
+    ('ix_follows_user_following_id', 'follows', ['user_following_id', 'user_being_followed_id']),
+    ('ix_likes_users_id', 'likes', ['users_id', 'message_id']),
+]
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, unique=False)
+        return
+
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} "
+                       f"ON {table} ({', '.join(columns)})")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table)
+        return
+
+    with op.get_context().autocommit_block():
+        for name, _, _ in reversed(INDEXES):
+            op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
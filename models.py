@@ -1,18 +1,43 @@
 """SQLAlchemy models for Warbler."""
 
+from collections import Counter
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, text
+from sqlalchemy.dialects import postgresql, sqlite
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from hashing import PasswordHasher
+from pagination import paginate_numbered
+from replicas import RoutingSQLAlchemy
+
+hasher = PasswordHasher()
+# reads may be routed to replicas (see replicas.py)
+db = RoutingSQLAlchemy()
+
+
+def insert_ignoring_duplicates(model):
+    """INSERT into `model`'s table that skips rows whose primary key is
+    already there (ON CONFLICT DO NOTHING), on Postgres or SQLite.
+
+    Its rowcount is the number of rows actually inserted.
+    """
+
+    dialects = {'postgresql': postgresql, 'sqlite': sqlite}
+    dialect = dialects[db.engine.dialect.name]
+
+    return dialect.insert(model.__table__).on_conflict_do_nothing()
 
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
     __tablename__ = 'follows'
+    __table_args__ = (
+        # the primary key leads with the followed user; this serves "who does
+        # this user follow" (follow lists, timeline fan-out, following_ids_among)
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
 
     user_being_followed_id = db.Column(
         db.Integer,
@@ -26,11 +51,69 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`? (a primary key lookup)"""
+
+        query = cls.query.filter_by(user_following_id=follower_id,
+                                    user_being_followed_id=followed_id)
+
+        return db.session.query(query.exists()).scalar()
+
+    @classmethod
+    def add(cls, follower_id, followed_id):
+        """Have `follower_id` follow `followed_id`, unless they already do.
+
+        True if this added the follow. A missing user still raises
+        IntegrityError.
+        """
+
+        insert = (insert_ignoring_duplicates(cls)
+                  .values(user_following_id=follower_id,
+                          user_being_followed_id=followed_id))
+
+        return db.session.execute(insert).rowcount == 1
+
+    @classmethod
+    def remove(cls, follower_id, followed_id):
+        """Have `follower_id` stop following `followed_id`; True if they
+        were."""
+
+        deleted = (cls.query
+                   .filter_by(user_following_id=follower_id,
+                              user_being_followed_id=followed_id)
+                   .delete(synchronize_session=False))
+
+        return deleted == 1
+
+    @classmethod
+    def followed_among(cls, follower_id, user_ids):
+        """Return the subset of `user_ids` that `follower_id` follows, in one
+        query against the primary key."""
+
+        user_ids = list(user_ids)
+
+        if not user_ids:
+            return set()
+
+        rows = (db.session.query(cls.user_being_followed_id)
+                .filter(cls.user_following_id == follower_id,
+                        cls.user_being_followed_id.in_(user_ids)))
+
+        return {user_id for (user_id,) in rows}
+
 
 class User(db.Model):
     """User in the system."""
 
     __tablename__ = 'users'
+    __table_args__ = (
+        # lets `username LIKE 'abc%'` use an index whatever the collation;
+        # on other databases this is a plain index on username
+        db.Index('ix_users_username_pattern',
+                 'username',
+                 postgresql_ops={'username': 'text_pattern_ops'}),
+    )
 
     id = db.Column(
         db.Integer,
@@ -72,15 +155,64 @@ class User(db.Model):
         nullable=False,
     )  ## to change later
 
-    messages = db.relationship('Message', order_by='Message.timestamp.desc()')
+    # denormalized counts shown on profile and home pages; kept up to date by
+    # the write routes (see `adjust_counts`) and rebuilt by `reconcile_counts`
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
 
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # when the profile or counts last changed, the row version behind the
+    # ETag/Last-Modified of pages showing this user; NULL until the first
+    # change after a bulk load
+    updated_at = db.Column(
+        db.DateTime,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+    )
+
+    # The collections below are queries rather than lists (lazy='dynamic'):
+    # iterating one runs its SELECT, and append()/remove() write a single row
+    # on flush without loading the rest, however big the collection is.
+    # passive_deletes leaves their rows to the ON DELETE CASCADEs when a user
+    # is deleted, instead of loading them all first.
+
+    messages = db.relationship('Message',
+                               order_by='Message.timestamp.desc()',
+                               lazy='dynamic',
+                               passive_deletes=True)
 
     # users who follow this user -- many to one
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id),
+        lazy='dynamic',
+        passive_deletes=True,
     )
 
     # users who this user follows  -- many to one
@@ -88,10 +220,16 @@ class User(db.Model):
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=(Follows.user_being_followed_id == id),
+        lazy='dynamic',
+        passive_deletes=True,
     )
     # Property that shows the messages liked by a user
-    liked_messages = db.relationship('Message', secondary="likes", backref='users_who_like')
+    liked_messages = db.relationship('Message',
+                                     secondary="likes",
+                                     backref='users_who_like',
+                                     lazy='dynamic',
+                                     passive_deletes=True)
 
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
@@ -99,15 +237,155 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(follower_id=other_user.id, followed_id=self.id)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
-    
+        return Follows.exists(follower_id=self.id, followed_id=other_user.id)
+
+    def following_ids_among(self, user_ids):
+        """Return the subset of `user_ids` that this user follows."""
+
+        return Follows.followed_among(self.id, user_ids)
+
+    @classmethod
+    def adjust_counts(cls, user_ids, **deltas):
+        """Add `deltas` to the counter columns of one or more users.
+
+        `user_ids` is a single id or anything `in_()` accepts (a list or a
+        select). The arithmetic happens in SQL, so concurrent writers don't
+        overwrite each other:
+
+            User.adjust_counts(user.id, messages_count=1)
+        """
+
+        if isinstance(user_ids, int):
+            criterion = cls.id == user_ids
+        else:
+            criterion = cls.id.in_(user_ids)
+
+        values = {getattr(cls, name): getattr(cls, name) + delta
+                  for name, delta in deltas.items()}
+        values[cls.updated_at] = datetime.utcnow()
+
+        cls.query.filter(criterion).update(values, synchronize_session=False)
+
+    @classmethod
+    def adjust_follow_counts(cls, follower_id, followed_id, delta):
+        """Add `delta` to one user's following_count and another's
+        followers_count.
+
+        The two rows are updated in id order, so two users following each
+        other at the same moment can't deadlock on each other's row.
+        """
+
+        updates = sorted([(follower_id, 'following_count'),
+                          (followed_id, 'followers_count')])
+
+        for user_id, name in updates:
+            cls.adjust_counts(user_id, **{name: delta})
+
+    @classmethod
+    def reconcile_counts(cls):
+        """Recompute every user's counter columns from the source tables.
+
+        On Postgres each count is one GROUP BY over its table joined back
+        with UPDATE ... FROM, so the cost is a scan per table rather than a
+        lookup per user. Other databases get a correlated subquery per user.
+        """
+
+        sources = [
+            (cls.messages_count, Message.user_id),
+            (cls.following_count, Follows.user_following_id),
+            (cls.followers_count, Follows.user_being_followed_id),
+            (cls.likes_count, Like.users_id),
+        ]
+
+        # every row may change, so every row gets a new version
+        now = datetime.utcnow()
+
+        if db.engine.dialect.name != 'postgresql':
+            values = {
+                counter: (db.select(db.func.count())
+                          .where(user_id == cls.id)
+                          .scalar_subquery())
+                for counter, user_id in sources
+            }
+            values[cls.updated_at] = now
+            cls.query.update(values, synchronize_session=False)
+            return
+
+        values = {counter: 0 for counter, _ in sources}
+        values[cls.updated_at] = now
+        cls.query.update(values, synchronize_session=False)
+
+        for counter, user_id in sources:
+            counts = (db.select(user_id.label('user_id'),
+                                db.func.count().label('total'))
+                      .group_by(user_id)
+                      .subquery())
+
+            (cls.query
+             .filter(cls.id == counts.c.user_id)
+             .update({counter: counts.c.total}, synchronize_session=False))
+
+    @classmethod
+    def search(cls, term, page, per_page, count_cap):
+        """Find users whose username matches `term`, best matches first.
+
+        Usernames starting with `term` come first, in order. On Postgres with
+        the pg_trgm trigram index they're followed by the other usernames
+        containing it (in any case), nearest by trigram distance first.
+        Anywhere else (or for terms too short for trigrams) it's just the
+        prefix matches.
+
+        Returns a `NumberedPage`; the total is counted up to `count_cap`.
+        """
+
+        pattern = (term.replace('\\', '\\\\')
+                       .replace('%', '\\%')
+                       .replace('_', '\\_'))
+        is_prefix = cls.username.like(f"{pattern}%", escape='\\')
+
+        if len(term) >= TRIGRAM_MIN_LENGTH and trigram_index_exists():
+            # prefix matches come from the username pattern index in order;
+            # the other matches from the GiST trigram index, which returns
+            # them nearest first (a KNN scan), so each half stops after
+            # count_cap + 1 rows instead of scoring every match
+            distance = cls.username.op('<->')(term)
+            prefix = (db.select(cls.id,
+                                db.literal(0).label('rank'),
+                                db.literal(0.0, db.Float).label('distance'))
+                      .where(is_prefix)
+                      .order_by(cls.username)
+                      .limit(count_cap + 1)
+                      .subquery())
+            substring = (db.select(cls.id,
+                                   db.literal(1).label('rank'),
+                                   distance.label('distance'))
+                         .where(cls.username.ilike(f"%{pattern}%",
+                                                   escape='\\'),
+                                ~is_prefix)
+                         .order_by(distance)
+                         .limit(count_cap + 1)
+                         .subquery())
+            ranked = db.union_all(db.select(prefix),
+                                  db.select(substring)).subquery()
+
+            query = (cls.query
+                     .options(USER_CARD)
+                     .join(ranked, ranked.c.id == cls.id)
+                     .order_by(ranked.c.rank,
+                               ranked.c.distance,
+                               cls.username))
+        else:
+            query = (cls.query
+                     .options(USER_CARD)
+                     .filter(is_prefix)
+                     .order_by(cls.username))
+
+        return paginate_numbered(query, page, per_page, count_cap)
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -116,7 +394,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -137,13 +415,19 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the stored hash was made with a different bcrypt cost than the
+        one configured, it is replaced with a fresh hash of `password`; the
+        caller commits the change.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
                 return user
 
         return False
@@ -153,6 +437,10 @@ class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
+    __table_args__ = (
+        # profile pages read one user's messages newest-first, a page at a time
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -185,6 +473,216 @@ class Message(db.Model):
 
 
 
+class CurrentUser:
+    """Read-only snapshot of the logged-in user, as stored in `g.user`.
+
+    Holds just what templates show (profile fields and counts) so it can be
+    cached between requests; routes that change the user load the real
+    `User` row instead.
+    """
+
+    FIELDS = (
+        'id', 'username', 'email', 'image_url', 'header_image_url', 'bio',
+        'location', 'messages_count', 'following_count', 'followers_count',
+        'likes_count', 'updated_at',
+    )
+
+    def __init__(self, **fields):
+        for field in self.FIELDS:
+            setattr(self, field, fields[field])
+
+    @classmethod
+    def from_user(cls, user):
+        """Take a snapshot of a `User`."""
+
+        return cls(**{field: getattr(user, field) for field in cls.FIELDS})
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+    def following_ids_among(self, user_ids):
+        """Return the subset of `user_ids` that this user follows."""
+
+        return Follows.followed_among(self.id, user_ids)
+
+
+# ================================================================= Search
+# Substring search on usernames uses a pg_trgm GiST index when the extension
+# is available; it's created along with the users table and skipped quietly
+# elsewhere (SQLite, or Postgres without contrib). GiST rather than GIN: a
+# GIN index can find the matches but not order them, so ranking them would
+# mean reading every one, while GiST hands them out nearest first.
+
+TRIGRAM_INDEX = 'ix_users_username_trgm'
+
+# trigrams are three characters, so shorter terms can't use the index
+TRIGRAM_MIN_LENGTH = 3
+
+
+def create_trigram_index(bind):
+    """Install pg_trgm and index usernames with it, if this is Postgres and
+    the extension is available; otherwise do nothing."""
+
+    if bind.dialect.name != 'postgresql':
+        return
+
+    available = bind.execute(text(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    )).scalar()
+
+    if available:
+        bind.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        bind.execute(text(
+            f"CREATE INDEX IF NOT EXISTS {TRIGRAM_INDEX} "
+            "ON users USING gist (username gist_trgm_ops)"))
+
+
+@event.listens_for(User.__table__, 'after_create')
+def _create_trigram_index(target, connection, **kw):
+    create_trigram_index(connection)
+
+
+_trigram_index_exists = None
+
+
+def trigram_index_exists():
+    """Has the trigram index been built? (checked once per process)"""
+
+    global _trigram_index_exists
+
+    if _trigram_index_exists is None:
+        _trigram_index_exists = (
+            db.engine.dialect.name == 'postgresql'
+            and db.session.execute(
+                text("SELECT 1 FROM pg_indexes WHERE indexname = :name"),
+                {'name': TRIGRAM_INDEX},
+            ).scalar() is not None
+        )
+
+    return _trigram_index_exists
+
+
+# ================================================================= Timelines
+# How many of a newly-followed user's messages get copied into the follower's
+# timeline; anything older than this is only visible on their profile.
+TIMELINE_BACKFILL_LIMIT = 1000
+
+
+class TimelineEntry(db.Model):
+    """A message delivered to a user's home timeline.
+
+    Rows are written when a message is posted (fan-out-on-write) so that
+    reading the home feed is a single range scan over (user_id, timestamp)
+    instead of a join across everyone the user follows.
+    """
+
+    __tablename__ = 'timeline_entries'
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_id_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+    )
+
+    # owner of the timeline
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    # copied from the message so unfollowing can trim without a join
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    # copied from the message so the feed can be ordered from this table alone
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    @classmethod
+    def fan_out(cls, message):
+        """Deliver a new (flushed) message to its author and their followers."""
+
+        followers = (db.select(Follows.user_following_id,
+                               db.literal(message.id),
+                               db.literal(message.user_id),
+                               db.literal(message.timestamp))
+                     .where(Follows.user_being_followed_id == message.user_id,
+                            # the author's own entry is added below, even if
+                            # an old row has them following themselves
+                            Follows.user_following_id != message.user_id))
+
+        db.session.add(cls(user_id=message.user_id,
+                           message_id=message.id,
+                           author_id=message.user_id,
+                           timestamp=message.timestamp))
+        db.session.execute(cls._insert_from(followers))
+
+    @classmethod
+    def backfill(cls, follower_id, followed_id, limit=TIMELINE_BACKFILL_LIMIT):
+        """Copy the most recent messages of `followed_id` into the timeline
+        of `follower_id`."""
+
+        recent = (db.select(db.literal(follower_id),
+                            Message.id,
+                            Message.user_id,
+                            Message.timestamp)
+                  .where(Message.user_id == followed_id)
+                  .order_by(Message.timestamp.desc())
+                  .limit(limit))
+
+        db.session.execute(cls._insert_from(recent))
+
+    @classmethod
+    def trim(cls, follower_id, followed_id):
+        """Remove the messages of `followed_id` from `follower_id`'s timeline."""
+
+        (cls.query
+         .filter_by(user_id=follower_id, author_id=followed_id)
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def rebuild(cls):
+        """Rebuild every timeline from the messages and follows tables.
+
+        Used after seeding or bulk loads that bypass the write paths.
+        """
+
+        cls.query.delete(synchronize_session=False)
+
+        own = db.select(Message.user_id,
+                        Message.id,
+                        Message.user_id.label('author_id'),
+                        Message.timestamp)
+        followed = (db.select(Follows.user_following_id,
+                              Message.id,
+                              Message.user_id,
+                              Message.timestamp)
+                    .join(Follows,
+                          Follows.user_being_followed_id == Message.user_id))
+
+        db.session.execute(cls._insert_from(own))
+        db.session.execute(cls._insert_from(followed))
+
+    @classmethod
+    def _insert_from(cls, select):
+        """INSERT ... SELECT of (user_id, message_id, author_id, timestamp),
+        skipping messages already in the timeline."""
+
+        return (insert_ignoring_duplicates(cls)
+                .from_select(['user_id', 'message_id', 'author_id', 'timestamp'],
+                             select))
+
+
 # ================================================================= Likes
 class Like(db.Model):
     """User liked messages""" 
@@ -192,16 +690,135 @@ class Like(db.Model):
     # every message can have many users liking it 
 
     __tablename__= "likes"
+    __table_args__ = (
+        # the primary key leads with the message; this serves "what has this
+        # user liked" (liked pages, like buttons, counts)
+        db.Index('ix_likes_users_id', 'users_id', 'message_id'),
+    )
+
     message_id = db.Column(db.Integer,
-                           db.ForeignKey('messages.id'), 
+                           db.ForeignKey('messages.id', ondelete='cascade'),
                            primary_key=True,
                            nullable=False)
                            
     users_id = db.Column(db.Integer,
-                         db.ForeignKey('users.id'), 
+                         db.ForeignKey('users.id', ondelete='cascade'),
                          primary_key=True, 
                          nullable=False) 
 
+    @classmethod
+    def liked_ids(cls, user_id, message_ids):
+        """Return the subset of `message_ids` that `user_id` has liked.
+
+        Used to render like buttons for one page of messages without loading
+        the user's whole liked_messages collection.
+        """
+
+        message_ids = list(message_ids)
+
+        if not message_ids:
+            return set()
+
+        rows = (db.session.query(cls.message_id)
+                .filter(cls.users_id == user_id,
+                        cls.message_id.in_(message_ids)))
+
+        return {message_id for (message_id,) in rows}
+
+    @classmethod
+    def add(cls, user_id, message_id):
+        """Have `user_id` like `message_id`, unless they already do.
+
+        True if this added the like. A missing user or message still raises
+        IntegrityError.
+        """
+
+        return cls.add_many([(user_id, message_id)])[user_id] == 1
+
+    @classmethod
+    def remove(cls, user_id, message_id):
+        """Have `user_id` unlike `message_id`; True if they liked it."""
+
+        return cls.remove_many([(user_id, message_id)])[user_id] == 1
+
+    @classmethod
+    def add_many(cls, pairs):
+        """Insert (user id, message id) likes in one statement, skipping
+        those already there.
+
+        Returns a Counter of the likes actually added per user id.
+        """
+
+        rows = [{'users_id': user_id, 'message_id': message_id}
+                for user_id, message_id in pairs]
+
+        if not rows:
+            return Counter()
+
+        insert = insert_ignoring_duplicates(cls).values(rows)
+
+        if len(rows) == 1:
+            added = db.session.execute(insert).rowcount
+            return Counter([rows[0]['users_id']] * added)
+
+        # which rows went in takes RETURNING (Postgres only)
+        if db.engine.dialect.name != 'postgresql':
+            added = Counter()
+            for pair in pairs:
+                added.update(cls.add_many([pair]))
+            return added
+
+        result = db.session.execute(insert.returning(cls.users_id))
+        return Counter(user_id for (user_id,) in result)
+
+    @classmethod
+    def remove_many(cls, pairs):
+        """Delete (user id, message id) likes in one statement.
+
+        Returns a Counter of the likes actually removed per user id.
+        """
+
+        pairs = list(pairs)
+
+        if not pairs:
+            return Counter()
+
+        if len(pairs) == 1:
+            user_id, message_id = pairs[0]
+            removed = (cls.query
+                       .filter_by(users_id=user_id, message_id=message_id)
+                       .delete(synchronize_session=False))
+            return Counter([user_id] * removed)
+
+        if db.engine.dialect.name != 'postgresql':
+            removed = Counter()
+            for pair in pairs:
+                removed.update(cls.remove_many([pair]))
+            return removed
+
+        delete = (db.delete(cls.__table__)
+                  .where(db.tuple_(cls.users_id, cls.message_id).in_(pairs))
+                  .returning(cls.users_id))
+
+        return Counter(user_id for (user_id,) in db.session.execute(delete))
+
+
+# ================================================================= Loader options
+# Eager loads for the relationships templates walk, applied per route with
+# `.options(...)` so a page runs a fixed number of queries however many
+# authors or users it shows.
+
+# the author of each message, in the same SELECT
+MESSAGE_AUTHOR = db.joinedload(Message.user)
+
+# just the columns a user card shows, for the directory, search results and
+# follow lists
+USER_CARD = db.load_only(User.id,
+                         User.username,
+                         User.image_url,
+                         User.header_image_url,
+                         User.bio)
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -210,4 +827,5 @@ def connect_db(app):
     """
 
     db.app = app
-    db.init_app(app)
\ No newline at end of file
+    db.init_app(app)
+    hasher.init_app(app)
\ No newline at end of file
@@ -0,0 +1,156 @@
+"""Pagination helpers for Warbler.
+
+Message lists use keyset (cursor) pagination: pages are fetched with
+``WHERE (timestamp, id) < (:ts, :id)`` rather than OFFSET, so page 50 costs
+the same single index range scan as page 1.
+
+The user directory pages the same way on id alone. Search results are
+ranked, so they use numbered pages instead, with the total match count
+capped to keep both the COUNT and the OFFSET bounded.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from datetime import datetime
+
+from sqlalchemy import func, tuple_
+
+
+class InvalidCursor(ValueError):
+    """Raised when a cursor from the querystring can't be decoded."""
+
+
+def encode_cursor(timestamp, id):
+    """Turn the (timestamp, id) of the last row on a page into an opaque
+    string suitable for a ``?before=`` querystring."""
+
+    raw = f"{timestamp.isoformat()}|{id}".encode('ascii')
+    return urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Reverse `encode_cursor`, returning a (timestamp, id) tuple."""
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp, id = urlsafe_b64decode(padded).decode('ascii').split('|')
+        return datetime.fromisoformat(timestamp), int(id)
+    except (Base64Error, UnicodeDecodeError, ValueError) as exc:
+        raise InvalidCursor(cursor) from exc
+
+
+class Page:
+    """One page of results plus the cursor for the next (older) page."""
+
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def paginate_before(query, timestamp_col, id_col, before, per_page):
+    """Return a `Page` of `query`, newest first, starting after `before`.
+
+    `timestamp_col` and `id_col` are the columns the query is keyed on; they
+    should be covered by an index for the scan to stay cheap, and the rows
+    returned must expose the same values as `.timestamp` and `.id`. `before`
+    is a cursor from a previous page (or None for the first page).
+
+    Raises InvalidCursor if `before` is malformed.
+    """
+
+    if before:
+        query = query.filter(
+            tuple_(timestamp_col, id_col) < decode_cursor(before))
+
+    # fetch one extra row to find out whether there is an older page
+    rows = (query
+            .order_by(timestamp_col.desc(), id_col.desc())
+            .limit(per_page + 1)
+            .all())
+
+    items = rows[:per_page]
+    next_cursor = None
+
+    if len(rows) > per_page:
+        last = items[-1]
+        next_cursor = encode_cursor(last.timestamp, last.id)
+
+    return Page(items, next_cursor)
+
+
+def paginate_after(query, id_col, after, per_page):
+    """Return a `Page` of `query` in ascending `id_col` order, starting after
+    the id `after` (or at the beginning when it's None).
+
+    Used for lists with no natural time order, like the user directory; the
+    next page's cursor is simply the last id shown.
+    """
+
+    if after is not None:
+        query = query.filter(id_col > after)
+
+    rows = query.order_by(id_col).limit(per_page + 1).all()
+
+    items = rows[:per_page]
+    next_cursor = items[-1].id if len(rows) > per_page else None
+
+    return Page(items, next_cursor)
+
+
+class NumberedPage:
+    """One page of ranked results, addressed by page number.
+
+    `total` is the number of matches, counted no further than `count_cap`;
+    `total_capped` is True when there were more than that.
+    """
+
+    def __init__(self, items, page, per_page, total, total_capped):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+        self.total_capped = total_capped
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def has_prev(self):
+        return self.page > 1
+
+    @property
+    def has_next(self):
+        return self.page * self.per_page < self.total
+
+
+def paginate_numbered(query, page, per_page, count_cap):
+    """Return a `NumberedPage` of an already-ordered `query`.
+
+    Neither the count nor the OFFSET ever looks past `count_cap` rows, so a
+    search matching millions of rows costs the same as one matching
+    `count_cap`.
+    """
+
+    capped = query.order_by(None).limit(count_cap + 1).subquery()
+    total = query.session.query(func.count()).select_from(capped).scalar()
+    total_capped = total > count_cap
+    total = min(total, count_cap)
+
+    page = max(1, page)
+    offset = (page - 1) * per_page
+
+    if offset >= total:
+        items = []
+    else:
+        items = query.offset(offset).limit(min(per_page, total - offset)).all()
+
+    return NumberedPage(items, page, per_page, total, total_capped)
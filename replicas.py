@@ -0,0 +1,132 @@
+"""Read replicas.
+
+With DATABASE_REPLICA_URLS set, GET requests to views marked
+`@replicas.read_only` run their queries against one of the replicas, picked
+at random per request, and everything else runs against the primary
+(DATABASE_URL). Writes always go to the primary, even from a read-only
+view.
+
+Replicas lag behind the primary a little, so a user who has just changed
+something (posted, liked, followed, edited their profile) is pinned to the
+primary for REPLICA_PIN_SECONDS afterwards and sees their own change at
+once. The pin is kept in their Flask session, so it holds whichever worker
+serves their next request.
+
+Any database SQLAlchemy can reach will do as a replica: in development, a
+second Postgres database (or an SQLite file) with the same tables stands in
+for one.
+"""
+
+import random
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, orm
+
+# session.info key holding the replica engine the session reads from
+REPLICA_KEY = 'replica'
+
+# Flask session key holding when (epoch seconds) the pin to the primary ends
+PIN_KEY = 'primary_until'
+
+
+class RoutingSession(SignallingSession):
+    """A session that reads from `info['replica']`, when it's set, and
+    writes to the primary."""
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        replica = self.info.get(REPLICA_KEY)
+
+        if (replica is None
+                or self._flushing
+                or getattr(clause, 'is_dml', False)):
+            return super().get_bind(mapper, clause)
+
+        return replica
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with `RoutingSession` sessions."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class Replicas:
+    """Sends read-only views' queries to the replicas.
+
+    Settings (app.config):
+
+    - DATABASE_REPLICA_URLS: list of replica database URLs (default none)
+    - REPLICA_PIN_SECONDS: how long after a write its user reads from the
+      primary (default 10)
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.engines = []
+
+    def init_app(self, app):
+        urls = app.config.setdefault('DATABASE_REPLICA_URLS', [])
+        self.pin_seconds = app.config.setdefault('REPLICA_PIN_SECONDS', 10)
+        self.engines = [create_engine(url) for url in urls]
+
+        event.listen(self.db.session, 'after_commit', self._after_commit)
+
+        app.before_request(self.route_request)
+        app.after_request(self.pin_writer)
+        app.teardown_request(self.end_request)
+
+    def read_only(self, view):
+        """Mark `view` as safe to serve (on GET) from a replica."""
+
+        view.reads_from_replica = True
+        return view
+
+    def route_request(self):
+        """Point this request's session at a replica, if it may use one."""
+
+        view = current_app.view_functions.get(request.endpoint)
+
+        if (not self.engines
+                or request.method not in ('GET', 'HEAD')
+                or not getattr(view, 'reads_from_replica', False)
+                or session.get(PIN_KEY, 0) > time.time()):
+            return
+
+        self.db.session().info[REPLICA_KEY] = random.choice(self.engines)
+
+    def end_request(self, error=None):
+        self.db.session().info.pop(REPLICA_KEY, None)
+
+    @contextmanager
+    def primary(self):
+        """Run the queries in this block against the primary, e.g. to fill a
+        cache that outlives the request."""
+
+        info = self.db.session().info
+        replica = info.pop(REPLICA_KEY, None)
+
+        try:
+            yield
+        finally:
+            if replica is not None:
+                info[REPLICA_KEY] = replica
+
+    def note_write(self):
+        """Pin the current user to the primary; called on every commit, and
+        by routes whose writes happen later (see writebuffer.py)."""
+
+        if has_request_context():
+            g.wrote_to_primary = True
+
+    def pin_writer(self, response):
+        if self.engines and g.get('wrote_to_primary'):
+            session[PIN_KEY] = time.time() + self.pin_seconds
+
+        return response
+
+    def _after_commit(self, db_session):
+        self.note_write()
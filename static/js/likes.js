@@ -0,0 +1,64 @@
+/* Like and unlike messages without reloading the page.
+ *
+ * The like buttons are plain form buttons, and still work that way without
+ * this script. With it, a click posts in the background; the server answers
+ * an empty 204 (or 202, when it batches likes) and the button flips to its
+ * other state. If anything goes
+ * wrong the form is submitted the ordinary way.
+ */
+
+(function () {
+  "use strict";
+
+  var LIKE = /\/like$/;
+  var UNLIKE = /\/unlike$/;
+
+  function toggle(button) {
+    var action = button.getAttribute("formaction");
+    var liked = LIKE.test(action);
+
+    button.setAttribute("formaction",
+      liked ? action.replace(LIKE, "/unlike") : action.replace(UNLIKE, "/like"));
+    button.classList.toggle("fas", liked);
+    button.classList.toggle("far", !liked);
+    button.style.color = liked ? "red" : "";
+  }
+
+  function submitNormally(button) {
+    var form = button.form;
+    form.setAttribute("action", button.getAttribute("formaction"));
+    form.submit();
+  }
+
+  document.addEventListener("click", function (event) {
+    var button = event.target.closest(
+      'button[formaction$="/like"], button[formaction$="/unlike"]');
+
+    if (!button || !window.fetch) {
+      return;
+    }
+
+    event.preventDefault();
+
+    if (button.disabled) {
+      return;
+    }
+    button.disabled = true;
+
+    fetch(button.getAttribute("formaction"), {
+      method: "POST",
+      credentials: "same-origin",
+      headers: { "Accept": "application/json" }
+    }).then(function (response) {
+      button.disabled = false;
+      if (response.status === 204 || response.status === 202) {
+        toggle(button);
+      } else {
+        submitNormally(button);
+      }
+    }, function () {
+      button.disabled = false;
+      submitNormally(button);
+    });
+  });
+})();
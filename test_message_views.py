@@ -6,9 +6,20 @@
 
 
 import os
+import tempfile
+import threading
+import time
+from html import unescape
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, connect_db, Message, User
+from flask import Flask
+from sqlalchemy import create_engine, event
+
+from metrics import Metrics
+from models import db, connect_db, Follows, Message, User, TimelineEntry
+from replicas import PIN_KEY
+from writebuffer import LikeBuffer
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -17,9 +28,14 @@ from models import db, connect_db, Message, User
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
+# and to keep cache invalidations in this process
+
+os.environ['INVALIDATION_BUS'] = "memory"
+
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import (app, metrics, fragment_cache, like_buffer, replicas,
+                 CURR_USER_KEY)
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -70,3 +86,524 @@ class MessageViewTestCase(TestCase):
 
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
+            self.assertEqual(msg.user.messages_count, 1)
+
+            # The new message is delivered to the author's own timeline
+            entry = TimelineEntry.query.one()
+            self.assertEqual(entry.user_id, self.testuser.id)
+            self.assertEqual(entry.message_id, msg.id)
+
+    def test_home_timeline_follow_unfollow(self):
+        """Does following fill the timeline and unfollowing trim it?"""
+
+        other = User.signup(username="otheruser",
+                            email="other@test.com",
+                            password="otheruser",
+                            image_url=None)
+        db.session.commit()
+        other.messages.append(Message(text="Hello from other"))
+        db.session.commit()
+        other_id = other.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get("/")
+            self.assertNotIn("Hello from other", resp.get_data(as_text=True))
+
+            c.post(f"/users/follow/{other_id}")
+            resp = c.get("/")
+            self.assertIn("Hello from other", resp.get_data(as_text=True))
+            self.assertEqual(User.query.get(self.testuser.id).following_count, 1)
+            self.assertEqual(User.query.get(other_id).followers_count, 1)
+
+            c.post(f"/users/stop-following/{other_id}")
+            resp = c.get("/")
+            self.assertNotIn("Hello from other", resp.get_data(as_text=True))
+            self.assertEqual(User.query.get(self.testuser.id).following_count, 0)
+            self.assertEqual(User.query.get(other_id).followers_count, 0)
+
+    def test_self_follow(self):
+        """Is following yourself refused, and does an old self-follow
+        neither break posting nor empty your feed when it's removed?"""
+
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.post(f"/users/follow/{testuser_id}")
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(Follows.query.count(), 0)
+
+            # a self-follow made before that was refused
+            Follows.add(testuser_id, testuser_id)
+            db.session.commit()
+
+            for text in ["first", "second"]:
+                resp = c.post("/messages/new", data={"text": text})
+                self.assertEqual(resp.status_code, 302)
+            self.assertEqual(
+                TimelineEntry.query.filter_by(user_id=testuser_id).count(), 2)
+
+            c.post(f"/users/stop-following/{testuser_id}")
+            self.assertEqual(Follows.query.count(), 0)
+            self.assertEqual(
+                TimelineEntry.query.filter_by(user_id=testuser_id).count(), 2)
+
+    def test_home_timeline_pagination(self):
+        """Does the home feed page with ?before= cursors?"""
+
+        for i in range(3):
+            msg = Message(text=f"Message {i}", user_id=self.testuser.id)
+            db.session.add(msg)
+            db.session.flush()
+            TimelineEntry.fan_out(msg)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get("/?limit=2")
+            html = resp.get_data(as_text=True)
+            self.assertIn("Message 2", html)
+            self.assertIn("Message 1", html)
+            self.assertNotIn("Message 0", html)
+
+            # the link to older messages keeps the page size
+            older = unescape(html.split('href="/?before=')[1].split('"')[0])
+            self.assertTrue(older.endswith("&limit=2"))
+            resp = c.get(f"/?before={older}")
+            html = resp.get_data(as_text=True)
+            self.assertIn("Message 0", html)
+            self.assertNotIn("Message 1", html)
+            self.assertNotIn("Older messages", html)
+
+            resp = c.get("/?before=not-a-cursor")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_home_liked_buttons(self):
+        """Does the home feed show unlike only for messages the viewer liked?"""
+
+        other = User.signup(username="otheruser",
+                            email="other@test.com",
+                            password="otheruser",
+                            image_url=None)
+        db.session.commit()
+
+        liked = Message(text="liked", user_id=other.id)
+        not_liked = Message(text="not liked", user_id=other.id)
+        db.session.add_all([liked, not_liked])
+        db.session.flush()
+        for msg in (liked, not_liked):
+            db.session.add(TimelineEntry(user_id=self.testuser.id,
+                                         message_id=msg.id,
+                                         author_id=other.id,
+                                         timestamp=msg.timestamp))
+        self.testuser.liked_messages.append(liked)
+        db.session.commit()
+        liked_id, not_liked_id = liked.id, not_liked.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn(f"/messages/{liked_id}/unlike", html)
+            self.assertNotIn(f"/messages/{liked_id}/like", html)
+            self.assertIn(f"/messages/{not_liked_id}/like", html)
+            self.assertNotIn(f"/messages/{not_liked_id}/unlike", html)
+
+    def test_like_toggle_json(self):
+        """Do scripted likes and unlikes answer 204 without reading the
+        timeline, and keep the like count right when repeated?"""
+
+        other = User.signup(username="otheruser",
+                            email="other@test.com",
+                            password="otheruser",
+                            image_url=None)
+        db.session.commit()
+
+        msg = Message(text="like me", user_id=other.id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id, testuser_id = msg.id, self.testuser.id
+        json_headers = {"Accept": "application/json"}
+
+        self.assertEqual(
+            self.client.post(f"/messages/{msg_id}/like",
+                             headers=json_headers).status_code,
+            401)
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = testuser_id
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            resp = self.client.post(f"/messages/{msg_id}/like",
+                                    headers=json_headers)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual(resp.status_code, 204)
+        self.assertFalse([s for s in statements if "timeline_entries" in s])
+        self.assertFalse([s for s in statements if "FROM messages" in s])
+
+        # liking twice is harmless
+        resp = self.client.post(f"/messages/{msg_id}/like", headers=json_headers)
+        self.assertEqual(resp.status_code, 204)
+
+        user = User.query.get(testuser_id)
+        self.assertEqual([m.id for m in user.liked_messages], [msg_id])
+        self.assertEqual(user.likes_count, 1)
+
+        for _ in range(2):
+            resp = self.client.post(f"/messages/{msg_id}/unlike",
+                                    headers=json_headers)
+            self.assertEqual(resp.status_code, 204)
+
+        db.session.expire_all()
+        user = User.query.get(testuser_id)
+        self.assertEqual(user.liked_messages.all(), [])
+        self.assertEqual(user.likes_count, 0)
+
+        # forms still get sent back to the feed
+        resp = self.client.post(f"/messages/{msg_id}/like")
+        self.assertEqual(resp.status_code, 302)
+
+        resp = self.client.post("/messages/0/like", headers=json_headers)
+        self.assertEqual(resp.status_code, 404)
+
+    def test_like_buffer(self):
+        """Are buffered likes written together, keeping only each pair's
+        last event?"""
+
+        authors = [User.signup(username=f"author{i}",
+                               email=f"author{i}@test.com",
+                               password="password",
+                               image_url=None)
+                   for i in range(2)]
+        db.session.flush()
+        msgs = [Message(text="hi", user_id=author.id) for author in authors]
+        db.session.add_all(msgs)
+        db.session.commit()
+        msg_ids = [msg.id for msg in msgs]
+        testuser_id = self.testuser.id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = testuser_id
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        like_buffer.enabled = True
+        # the test writes the buffer itself
+        like_buffer.interval = 3600
+        try:
+            headers = {"Accept": "application/json"}
+            for msg_id in msg_ids:
+                resp = self.client.post(f"/messages/{msg_id}/like",
+                                        headers=headers)
+                self.assertEqual(resp.status_code, 202)
+            self.client.post(f"/messages/{msg_ids[1]}/unlike", headers=headers)
+            self.client.post(f"/messages/{msg_ids[1]}/like", headers=headers)
+
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                like_buffer.flush()
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+
+            # a deleted message only loses its own like
+            like_buffer.add(testuser_id, msg_ids[0], liked=False)
+            like_buffer.add(testuser_id, 0, liked=True)
+            like_buffer.flush()
+        finally:
+            like_buffer.enabled = False
+            like_buffer.interval = app.config['LIKE_BUFFER_SECONDS']
+
+        inserts = [s for s in statements if s.startswith("INSERT INTO likes")]
+        self.assertEqual(len(inserts), 1)
+
+        user = User.query.get(testuser_id)
+        self.assertEqual([m.id for m in user.liked_messages], msg_ids[1:])
+        self.assertEqual(user.likes_count, 1)
+
+    def test_like_buffer_starts_once(self):
+        """Do simultaneous first likes in a worker start one writer thread,
+        with none of them getting ahead of it?"""
+
+        buffer = LikeBuffer()
+        buffer.init_app(app)
+        buffer.interval = 3600
+        # every like wakes the writer, which has nothing to write here
+        buffer.max_size = 1
+        buffer.flush = lambda: None
+
+        class SlowEvent(threading.Event):
+            # widen the gap between starting and having a thread to wake
+            def __init__(self):
+                time.sleep(0.05)
+                super().__init__()
+
+        def writers():
+            return sum(thread.name == 'like-buffer'
+                       for thread in threading.enumerate())
+
+        before = writers()
+        barrier = threading.Barrier(8)
+        errors = []
+
+        def like(message_id):
+            barrier.wait()
+            try:
+                buffer.add(self.testuser.id, message_id, liked=True)
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=like, args=(message_id,))
+                   for message_id in range(8)]
+        with patch('writebuffer.threading.Event', SlowEvent):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(writers(), before + 1)
+        self.assertEqual(len(buffer._pending), 8)
+
+    def test_home_query_count(self):
+        """Does the home feed run the same number of queries however many
+        authors it shows?"""
+
+        def count_home_queries(num_authors):
+            for i in range(num_authors):
+                author = User.signup(username=f"author{num_authors}-{i}",
+                                     email=f"author{num_authors}-{i}@test.com",
+                                     password="password",
+                                     image_url=None)
+                db.session.flush()
+                msg = Message(text="hi", user_id=author.id)
+                db.session.add(msg)
+                db.session.flush()
+                db.session.add(TimelineEntry(user_id=self.testuser.id,
+                                             message_id=msg.id,
+                                             author_id=author.id,
+                                             timestamp=msg.timestamp))
+            db.session.commit()
+
+            # warm the current-user cache so both counts see the same state
+            self.client.get("/")
+            statements = []
+
+            def record(conn, cursor, statement, *args):
+                statements.append(statement)
+
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                self.client.get("/")
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+
+            return len(statements)
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser.id
+
+        self.assertEqual(count_home_queries(1), count_home_queries(3))
+
+    def test_metrics(self):
+        """Do responses report their timings, and /metrics the totals?"""
+
+        metrics.reset()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser.id
+
+        resp = self.client.get("/")
+        server_timing = resp.headers['Server-Timing']
+
+        self.assertRegex(server_timing, r'db;dur=[\d.]+;desc="\d+ queries"')
+        self.assertIn("render;dur=", server_timing)
+        self.assertIn("total;dur=", server_timing)
+
+        text = metrics.render()
+
+        self.assertRegex(
+            text,
+            r'warbler_http_requests_total\{pid="\d+",endpoint="homepage",'
+            r'status="200"\} 1\n')
+        self.assertRegex(
+            text,
+            r'warbler_db_queries_total\{pid="\d+",endpoint="homepage"\} [1-9]')
+        self.assertRegex(
+            text,
+            r'warbler_http_request_duration_seconds_count'
+            r'\{pid="\d+",endpoint="homepage"\} 1\n')
+
+    def test_metrics_endpoint(self):
+        """Is /metrics off by default, and otherwise only served to scrapes
+        with the token or from an allowed address?"""
+
+        def metrics_client(**config):
+            metrics_app = Flask(__name__)
+            metrics_app.config.update(config)
+            Metrics().init_app(metrics_app)
+            return metrics_app.test_client()
+
+        self.assertEqual(metrics_client().get("/metrics").status_code, 404)
+
+        with self.assertRaises(RuntimeError):
+            metrics_client(METRICS_PATH="/metrics")
+
+        client = metrics_client(METRICS_PATH="/metrics",
+                                METRICS_TOKEN="s3cret",
+                                METRICS_ALLOWED_IPS=["10.0.0.0/8"])
+        bearer = {'Authorization': "Bearer s3cret"}
+        wrong = {'Authorization': "Bearer guess"}
+        inside = {'REMOTE_ADDR': "10.1.2.3"}
+
+        self.assertEqual(client.get("/metrics").status_code, 403)
+        self.assertEqual(client.get("/metrics", headers=wrong).status_code,
+                         403)
+        self.assertEqual(client.get("/metrics", headers=bearer).status_code,
+                         200)
+        self.assertEqual(client.get("/metrics",
+                                    environ_base=inside).status_code, 200)
+
+    def test_message_show_conditional_get(self):
+        """Is an unchanged message page a 304 without rendering?"""
+
+        msg = Message(text="hello", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        resp = self.client.get(f"/messages/{msg_id}")
+        self.assertEqual(resp.status_code, 200)
+        etag = resp.headers['ETag']
+        last_modified = resp.headers['Last-Modified']
+
+        resp = self.client.get(f"/messages/{msg_id}",
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+        resp = self.client.get(f"/messages/{msg_id}",
+                               headers={'If-Modified-Since': last_modified})
+        self.assertEqual(resp.status_code, 304)
+
+        # logging in changes the page (navbar, delete button)
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser.id
+
+        resp = self.client.get(f"/messages/{msg_id}",
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Delete", resp.get_data(as_text=True))
+
+        self.assertEqual(self.client.get("/messages/0").status_code, 404)
+
+    def test_message_fragments(self):
+        """Do cached message fragments get each viewer's like button, and
+        change when their author does?"""
+
+        other = User.signup(username="otheruser",
+                            email="other@test.com",
+                            password="otheruser",
+                            image_url=None)
+        db.session.commit()
+
+        msg = Message(text="cache me", user_id=other.id)
+        db.session.add(msg)
+        self.testuser.liked_messages.append(msg)
+        db.session.commit()
+        msg_id, other_id, testuser_id = msg.id, other.id, self.testuser.id
+        liked_page = f"/users/{testuser_id}/liked_messages"
+
+        fragment_cache.clear()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = testuser_id
+        html = self.client.get(liked_page).get_data(as_text=True)
+        self.assertIn(f"/messages/{msg_id}/unlike", html)
+        self.assertEqual(len(fragment_cache), 1)
+
+        # the author sees the same fragment with no button at all
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = other_id
+        html = self.client.get(liked_page).get_data(as_text=True)
+        self.assertIn("cache me", html)
+        self.assertNotIn(f"/messages/{msg_id}/unlike", html)
+        self.assertNotIn(f"/messages/{msg_id}/like", html)
+        self.assertEqual(len(fragment_cache), 1)
+
+        other = User.query.get(other_id)
+        other.username = "renamed"
+        db.session.commit()
+
+        html = self.client.get(liked_page).get_data(as_text=True)
+        self.assertIn("@renamed", html)
+        self.assertNotIn("@otheruser", html)
+
+    def test_read_replica(self):
+        """Are read-only pages served from a replica, except to a user who
+        has just written something?"""
+
+        other = User.signup(username="otheruser",
+                            email="other@test.com",
+                            password="otheruser",
+                            image_url=None)
+        db.session.flush()
+        msg = Message(text="on the primary", user_id=other.id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id, testuser_id = msg.id, self.testuser.id
+
+        with tempfile.TemporaryDirectory() as replica_dir:
+            # an SQLite file standing in for a replica that is behind: it has
+            # an older copy of the message, and not the logged-in user at all
+            replica = create_engine(f"sqlite:///{replica_dir}/replica.db")
+            db.metadata.create_all(replica)
+            with replica.begin() as conn:
+                conn.execute(User.__table__.insert(),
+                             {column.name: getattr(other, column.name)
+                              for column in User.__table__.columns})
+                conn.execute(Message.__table__.insert(),
+                             {'id': msg_id,
+                              'text': "on the replica",
+                              'timestamp': msg.timestamp,
+                              'user_id': other.id})
+
+            replicas.engines = [replica]
+            try:
+                with self.client.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = testuser_id
+
+                html = self.client.get(f"/messages/{msg_id}").get_data(as_text=True)
+                self.assertIn("on the replica", html)
+                # the logged-in user still came from the primary
+                self.assertIn("New Message", html)
+
+                # a write pins the writer to the primary for a while
+                self.client.post(f"/messages/{msg_id}/like")
+                html = self.client.get(f"/messages/{msg_id}").get_data(as_text=True)
+                self.assertIn("on the primary", html)
+
+                with self.client.session_transaction() as sess:
+                    sess[PIN_KEY] = 0
+                html = self.client.get(f"/messages/{msg_id}").get_data(as_text=True)
+                self.assertIn("on the replica", html)
+            finally:
+                replicas.engines = []
+                replica.dispose()
@@ -7,11 +7,12 @@
 
 from logging import error
 import os
+import re
 from unittest import TestCase
 from flask_bcrypt import Bcrypt
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, hasher, trigram_index_exists
 from psycopg2.errors import UniqueViolation
-from sqlalchemy import exc
+from sqlalchemy import event, exc
 import pdb
 
 bcrypt = Bcrypt()
@@ -23,6 +24,10 @@ bcrypt = Bcrypt()
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
+# and to keep cache invalidations in this process
+
+os.environ['INVALIDATION_BUS'] = "memory"
+
 # Now we can import app
 
 from app import app
@@ -81,8 +86,8 @@ class UserModelTestCase(TestCase):
         """Does basic model work?"""
         u1 = User.query.get(self.u1_id)
         # User should have no messages & no followers
-        self.assertEqual(len(u1.messages), 0)
-        self.assertEqual(len(u1.followers), 0)
+        self.assertEqual(u1.messages.count(), 0)
+        self.assertEqual(u1.followers.count(), 0)
 
 
     def test_user_repr(self):
@@ -222,3 +227,179 @@ class UserModelTestCase(TestCase):
 
         self.assertFalse(result3)
 
+
+    def test_collection_writes_dont_load_collections(self):
+        """Make sure appending to and removing from a user's collections, and
+           deleting the user, never SELECT the collections themselves"""
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        msg = Message(text="hi", user_id=self.u2_id)
+        db.session.add(msg)
+        db.session.commit()
+        db.session.refresh(msg)
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            u1.following.append(u2)
+            u1.liked_messages.append(msg)
+            u2.messages.append(Message(text="another"))
+            db.session.commit()
+
+            u1 = User.query.get(self.u1_id)
+            u2 = User.query.get(self.u2_id)
+            u1.following.remove(u2)
+            db.session.commit()
+
+            db.session.delete(User.query.get(self.u2_id))
+            db.session.commit()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        collection_reads = [statement for statement in statements
+                            if statement.startswith("SELECT")
+                            and re.search(r"\b(follows|likes|messages)\b",
+                                          statement)]
+        self.assertEqual(collection_reads, [])
+        self.assertEqual(Message.query.count(), 0)
+
+    def test_reconcile_counts(self):
+        """Make sure User.reconcile_counts rebuilds the counter columns from
+           the follows, messages and likes tables"""
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        msg = Message(text="counted")
+        u2.messages.append(msg)
+        u1.following.append(u2)
+        u1.liked_messages.append(msg)
+        db.session.commit()
+
+        User.reconcile_counts()
+        db.session.commit()
+
+        self.assertEqual(u1.following_count, 1)
+        self.assertEqual(u1.likes_count, 1)
+        self.assertEqual(u2.followers_count, 1)
+        self.assertEqual(u2.messages_count, 1)
+        self.assertEqual(u2.following_count, 0)
+
+    def test_adjust_counts(self):
+        """Make sure User.adjust_counts changes counters in place"""
+
+        User.adjust_counts(self.u1_id, messages_count=2, likes_count=1)
+        User.adjust_counts([self.u1_id, self.u2_id], followers_count=1)
+        db.session.commit()
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        self.assertEqual(u1.messages_count, 2)
+        self.assertEqual(u1.likes_count, 1)
+        self.assertEqual(u1.followers_count, 1)
+        self.assertEqual(u2.followers_count, 1)
+
+    def test_following_ids_among(self):
+        """Make sure following_ids_among returns only the ids user1 follows"""
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        u1.following.append(u2)
+        db.session.commit()
+
+        self.assertEqual(u1.following_ids_among([self.u1_id, self.u2_id]),
+                         {self.u2_id})
+        self.assertEqual(u2.following_ids_among([self.u1_id, self.u2_id]),
+                         set())
+        self.assertEqual(u1.following_ids_among([]), set())
+
+    def test_user_search(self):
+        """Make sure User.search ranks an exact match first, pages results and
+           caps the total count"""
+
+        for name in ["testuser10", "testuser1_", "testuse1"]:
+            User.signup(username=name,
+                        email=f"{name}@test.com",
+                        password="HASHED_PASSWORD",
+                        image_url="")
+        db.session.commit()
+
+        results = User.search("testuser1", page=1, per_page=2, count_cap=10)
+        self.assertEqual([u.username for u in results],
+                         ["testuser1", "testuser10"])
+        self.assertEqual(results.total, 3)
+        self.assertFalse(results.total_capped)
+        self.assertTrue(results.has_next)
+
+        results = User.search("testuser1", page=2, per_page=2, count_cap=10)
+        self.assertEqual([u.username for u in results], ["testuser1_"])
+        self.assertFalse(results.has_next)
+
+        results = User.search("testuser", page=1, per_page=2, count_cap=2)
+        self.assertEqual(results.total, 2)
+        self.assertTrue(results.total_capped)
+
+        # LIKE wildcards in the term are matched literally
+        results = User.search("testuser1_", page=1, per_page=10, count_cap=10)
+        self.assertEqual([u.username for u in results], ["testuser1_"])
+
+    def test_user_search_trigram(self):
+        """Make sure trigram search puts prefix matches first, however many
+           other names contain the term"""
+
+        if not trigram_index_exists():
+            self.skipTest("needs the pg_trgm extension")
+
+        # more substring matches than the cap, all older than the best ones
+        for i in range(10):
+            User.signup(username=f"a{i}searchme",
+                        email=f"a{i}@test.com",
+                        password="HASHED_PASSWORD",
+                        image_url="")
+        for name in ["searchme2", "searchme", "SearchMeToo"]:
+            User.signup(username=name,
+                        email=f"{name}@test.com",
+                        password="HASHED_PASSWORD",
+                        image_url="")
+        db.session.commit()
+
+        results = User.search("searchme", page=1, per_page=3, count_cap=5)
+        self.assertEqual([u.username for u in results][:2],
+                         ["searchme", "searchme2"])
+        self.assertEqual(results.total, 5)
+        self.assertTrue(results.total_capped)
+
+        # the rest are substring matches, case-insensitively
+        results = User.search("searchme", page=1, per_page=20, count_cap=20)
+        names = [u.username for u in results]
+        self.assertEqual(len(names), 13)
+        self.assertIn("SearchMeToo", names[2:])
+
+    def test_authenticate_rehashes(self):
+        """Make sure User.authenticate upgrades a hash made with a different
+           bcrypt cost than the configured one"""
+
+        u1 = User.query.get(self.u1_id)
+        old_hash = u1.password
+        self.assertFalse(hasher.needs_rehash(old_hash))
+
+        configured_rounds = hasher.rounds
+        hasher.rounds = 4
+        try:
+            user = User.authenticate('testuser1', 'HASHED_PASSWORD')
+            db.session.commit()
+        finally:
+            hasher.rounds = configured_rounds
+
+        self.assertEqual(user, u1)
+        self.assertNotEqual(u1.password, old_hash)
+        self.assertTrue(u1.password.startswith('$2b$04$'))
+        self.assertTrue(User.authenticate('testuser1', 'HASHED_PASSWORD'))
+
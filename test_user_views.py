@@ -5,10 +5,19 @@
 #    FLASK_ENV=production python -m unittest test_user_views.py
 
 
+import gzip
 import os
+import queue
+import tempfile
+from html import unescape
 from unittest import TestCase
 
-from models import db, connect_db, User
+from assets import build as build_assets
+from explain import (capture_selects, check_pages, explain, full_scans,
+                     hot_pages, index_columns)
+from invalidation import PostgresBus
+from models import db, connect_db, User, Message
+from sqlalchemy import create_engine
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -17,9 +26,13 @@ from models import db, connect_db, User
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
+# and to keep cache invalidations in this process
+
+os.environ['INVALIDATION_BUS'] = "memory"
+
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, assets, current_user_cache, replicas, CURR_USER_KEY
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -214,5 +227,389 @@ class MessageViewTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 200)
             self.assertIn(f'{testuser.username}', html)
-  
-  
+
+
+    def test_users_follow_buttons(self):
+        """test users page shows unfollow only for followed users"""
+
+        other = User.signup(username="otheruser",
+                            email="other@test.com",
+                            password="otheruser",
+                            image_url=None)
+        stranger = User.signup(username="stranger",
+                               email="stranger@test.com",
+                               password="stranger",
+                               image_url=None)
+        db.session.commit()
+
+        testuser = User.query.get(self.user_id)
+        testuser.following.append(other)
+        db.session.commit()
+        other_id, stranger_id = other.id, stranger.id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        html = self.client.get('/users').get_data(as_text=True)
+
+        self.assertIn(f'action="/users/stop-following/{other_id}"', html)
+        self.assertIn(f'action="/users/follow/{stranger_id}"', html)
+        self.assertNotIn(f'action="/users/follow/{other_id}"', html)
+        # no button on the viewer's own card
+        self.assertNotIn(f'action="/users/follow/{self.user_id}"', html)
+
+    def test_users_search(self):
+        """test users page search by username"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        resp = self.client.get('/users?q=testu')
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('@testuser', html)
+        self.assertIn('1 users matching', html)
+
+        resp = self.client.get('/users?q=nobody')
+        self.assertIn('Sorry, no users found', resp.get_data(as_text=True))
+
+        # result pages keep the page size
+        for i in range(3):
+            User.signup(username=f"found{i}",
+                        email=f"found{i}@test.com",
+                        password="password",
+                        image_url=None)
+        db.session.commit()
+
+        html = self.client.get('/users?q=found&limit=2').get_data(as_text=True)
+        self.assertIn('href="/users?q=found&amp;page=2&amp;limit=2"', html)
+        html = self.client.get('/users?q=found&page=2&limit=2').get_data(
+            as_text=True)
+        self.assertIn('@found2', html)
+        self.assertIn('href="/users?q=found&amp;page=1&amp;limit=2"', html)
+
+    def test_users_directory_paging(self):
+        """test users directory pages with ?after= and can be streamed"""
+
+        for i in range(3):
+            User.signup(username=f"paged{i}",
+                        email=f"paged{i}@test.com",
+                        password="password",
+                        image_url=None)
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        html = self.client.get('/users?limit=2').get_data(as_text=True)
+        self.assertIn('@testuser', html)
+        self.assertIn('@paged0', html)
+        self.assertNotIn('@paged1', html)
+
+        # the link to more users keeps the page size
+        after = unescape(html.split('/users?after=')[1].split('"')[0])
+        self.assertTrue(after.endswith('&limit=2'))
+        html = self.client.get(f'/users?after={after}').get_data(
+            as_text=True)
+        self.assertIn('@paged1', html)
+        self.assertIn('@paged2', html)
+        self.assertNotIn('@paged0', html)
+        self.assertNotIn('More users', html)
+
+        app.config['STREAM_USER_DIRECTORY'] = True
+        try:
+            resp = self.client.get('/users')
+            self.assertTrue(resp.is_streamed)
+            self.assertIn('@paged2', resp.get_data(as_text=True))
+        finally:
+            app.config['STREAM_USER_DIRECTORY'] = False
+
+    def test_user_detail_paging(self):
+        """test user detail page shows a page of messages with an older link"""
+
+        for i in range(3):
+            db.session.add(Message(text=f"Profile message {i}",
+                                   user_id=self.user_id))
+            db.session.commit()
+
+        resp = self.client.get(f'/users/{self.user_id}?limit=2')
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('Profile message 2', html)
+        self.assertIn('Profile message 1', html)
+        self.assertNotIn('Profile message 0', html)
+
+        # the link to older messages keeps the page size
+        older = unescape(html.split('?before=')[1].split('"')[0])
+        self.assertTrue(older.endswith('&limit=2'))
+        html = self.client.get(
+            f'/users/{self.user_id}?before={older}').get_data(as_text=True)
+        self.assertIn('Profile message 0', html)
+        self.assertNotIn('Profile message 1', html)
+
+    def test_profile_edit_refreshes_current_user(self):
+        """test editing the profile drops the cached current user"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        html = self.client.get('/').get_data(as_text=True)
+        self.assertIn('@testuser', html)
+
+        resp = self.client.post('/users/profile',
+                                data={"username": "renamed",
+                                      "email": "test@test.com",
+                                      "password": "testuser"})
+        self.assertEqual(resp.status_code, 302)
+
+        html = self.client.get('/').get_data(as_text=True)
+        self.assertIn('@renamed', html)
+        self.assertNotIn('@testuser', html)
+
+
+    def test_user_detail_conditional_get(self):
+        """test an unchanged profile is a 304, and a follow changes it"""
+
+        other = User.signup(username="otheruser",
+                            email="other@test.com",
+                            password="otheruser",
+                            image_url=None)
+        db.session.commit()
+        other_id = other.id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        resp = self.client.get(f'/users/{other_id}')
+        etag = resp.headers['ETag']
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('no-cache', resp.headers['Cache-Control'])
+        self.assertIn('Last-Modified', resp.headers)
+
+        resp = self.client.get(f'/users/{other_id}',
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.get_data(), b'')
+
+        self.client.post(f'/users/follow/{other_id}')
+
+        resp = self.client.get(f'/users/{other_id}',
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        self.assertIn('Unfollow', resp.get_data(as_text=True))
+
+    def test_follow_twice(self):
+        """test double follows and unfollows change the counts only once"""
+
+        other = User.signup(username="otheruser",
+                            email="other@test.com",
+                            password="otheruser",
+                            image_url=None)
+        db.session.commit()
+        other_id = other.id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        for _ in range(2):
+            resp = self.client.post(f'/users/follow/{other_id}')
+            self.assertEqual(resp.status_code, 302)
+
+        testuser = User.query.get(self.user_id)
+        self.assertEqual([u.id for u in testuser.following], [other_id])
+        self.assertEqual(testuser.following_count, 1)
+        self.assertEqual(User.query.get(other_id).followers_count, 1)
+
+        for _ in range(2):
+            resp = self.client.post(f'/users/stop-following/{other_id}')
+            self.assertEqual(resp.status_code, 302)
+
+        db.session.expire_all()
+        testuser = User.query.get(self.user_id)
+        self.assertEqual(testuser.following.all(), [])
+        self.assertEqual(testuser.following_count, 0)
+        self.assertEqual(User.query.get(other_id).followers_count, 0)
+
+        resp = self.client.post('/users/follow/0')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_cache_policy(self):
+        """test static files are cached and other pages aren't stored"""
+
+        resp = self.client.get('/static/stylesheets/style.css')
+        self.assertIn('public', resp.headers['Cache-Control'])
+        self.assertIn('max-age=', resp.headers['Cache-Control'])
+        resp.close()
+
+        resp = self.client.get('/login')
+        self.assertEqual(resp.headers['Cache-Control'], 'no-store')
+        self.assertNotIn('ETag', resp.headers)
+
+    def test_profile_edit_evicts_cached_snapshot(self):
+        """test a profile edit evicts the cached snapshot once it commits"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        self.client.get('/')
+        self.assertIsNotNone(current_user_cache.get(self.user_id))
+
+        self.client.post('/users/profile',
+                         data={"username": "renamed",
+                               "email": "test@test.com",
+                               "password": "testuser"})
+
+        self.assertIsNone(current_user_cache.get(self.user_id))
+
+    def test_postgres_invalidation_bus(self):
+        """test NOTIFY reaches another listener on commit, not on rollback"""
+
+        publisher = PostgresBus(db)
+        listener = PostgresBus(db)
+        received = queue.Queue()
+        listener.subscribe('user',
+                           lambda *keys: received.put(keys),
+                           lambda: received.put('clear'))
+        self.assertTrue(listener.wait_until_listening(timeout=5))
+        self.assertEqual(received.get(timeout=5), 'clear')
+
+        publisher.publish('user', [1, 2])
+        db.session.rollback()
+        publisher.publish('user', [3])
+        db.session.commit()
+
+        self.assertEqual(received.get(timeout=5), (3,))
+        self.assertTrue(received.empty())
+
+    def test_query_plans(self):
+        """test the busiest pages' queries all use an index, and that the
+        check notices one that can't"""
+
+        other = User.signup(username="otheruser",
+                            email="other@test.com",
+                            password="otheruser",
+                            image_url=None)
+        db.session.commit()
+        other_id = other.id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        self.client.post(f'/users/follow/{other_id}')
+        msg = Message(text="planned", user_id=other_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+        self.client.post(f'/messages/{msg_id}/like')
+
+        viewer = User.query.get(self.user_id)
+        urls = hot_pages(viewer, Message.query.get(msg_id), 'tes')
+
+        self.assertEqual(check_pages(app, urls, {CURR_USER_KEY: self.user_id}),
+                         [])
+
+        indexes = index_columns()
+        unindexed = explain("SELECT id FROM users WHERE bio = %(bio)s",
+                            {'bio': 'x'})
+        self.assertEqual(full_scans(unindexed, indexes), ['users'])
+
+        # timeline_entries' indexes all start with user_id, so this reads
+        # the whole of one
+        by_message = explain("SELECT user_id FROM timeline_entries "
+                             "WHERE message_id = %(id)s", {'id': msg_id})
+        self.assertEqual(full_scans(by_message, indexes),
+                         ['timeline_entries'])
+
+    def test_query_plans_on_replica(self):
+        """test the plan check sees the queries of pages served from a
+        replica, and explains them there"""
+
+        msg = Message(text="replicated", user_id=self.user_id)
+        db.session.add(msg)
+        db.session.commit()
+
+        viewer = User.query.get(self.user_id)
+        urls = hot_pages(viewer, msg, 'tes')
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        # a second engine on the test database stands in for a replica
+        replica = create_engine(db.engine.url)
+        replicas.engines = [replica]
+        try:
+            selects = capture_selects(
+                lambda: self.client.get(f'/users/{self.user_id}'))
+            self.assertIn(replica, [engine for engine, _, _ in selects])
+
+            self.assertEqual(
+                check_pages(app, urls, {CURR_USER_KEY: self.user_id}), [])
+        finally:
+            replicas.engines = []
+            replica.dispose()
+
+    def test_fingerprinted_assets(self):
+        """test built assets are linked, immutable and precompressed"""
+
+        with tempfile.TemporaryDirectory() as dist_dir:
+            manifest = build_assets(dist_dir=dist_dir)
+            hashed_css = manifest['stylesheets/style.css']
+            self.assertRegex(hashed_css, r'^stylesheets/style\.[0-9a-f]{12}\.css$')
+
+            with open(os.path.join(dist_dir, hashed_css)) as css:
+                self.assertIn('/assets/images/nav-bg.', css.read())
+
+            old_dist_dir = assets.dist_dir
+            assets.dist_dir = dist_dir
+            assets.load_manifest()
+            try:
+                html = self.client.get('/login').get_data(as_text=True)
+                self.assertIn(f'href="/assets/{hashed_css}"', html)
+
+                resp = self.client.get(f'/assets/{hashed_css}',
+                                       headers={'Accept-Encoding': 'gzip'})
+                self.assertEqual(resp.content_encoding, 'gzip')
+                self.assertEqual(resp.mimetype, 'text/css')
+                self.assertIn('immutable', resp.headers['Cache-Control'])
+                self.assertIn('Accept-Encoding', resp.headers['Vary'])
+                self.assertIn(b'nav-bg', gzip.decompress(resp.get_data()))
+                resp.close()
+
+                resp = self.client.get(f'/assets/{hashed_css}')
+                self.assertIsNone(resp.content_encoding)
+                self.assertIn(b'nav-bg', resp.get_data())
+                resp.close()
+
+                resp = self.client.get('/assets/../app.py')
+                self.assertEqual(resp.status_code, 404)
+            finally:
+                assets.dist_dir = old_dist_dir
+                assets.load_manifest()
+
+    def test_compression(self):
+        """test pages are gzipped when accepted, streamed ones as they go"""
+
+        resp = self.client.get('/login', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.content_encoding, 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertIn(b'Log in', gzip.decompress(resp.get_data()))
+
+        resp = self.client.get('/login')
+        self.assertIsNone(resp.content_encoding)
+
+        # too small to be worth it
+        resp = self.client.get('/logout', headers={'Accept-Encoding': 'gzip'})
+        self.assertIsNone(resp.content_encoding)
+
+        app.config['STREAM_USER_DIRECTORY'] = True
+        try:
+            resp = self.client.get('/users',
+                                   headers={'Accept-Encoding': 'gzip'})
+            self.assertTrue(resp.is_streamed)
+            self.assertEqual(resp.content_encoding, 'gzip')
+            self.assertIn(b'@testuser', gzip.decompress(resp.get_data()))
+        finally:
+            app.config['STREAM_USER_DIRECTORY'] = False
@@ -0,0 +1,153 @@
+"""Batched like writes.
+
+With LIKE_BUFFER_ENABLED, likes and unlikes made from the page's script
+(see static/js/likes.js) aren't written by the request. They're collected
+in the worker and written every LIKE_BUFFER_SECONDS by a thread of its own:
+one multi-row INSERT for the likes, one DELETE for the unlikes, and a
+counter UPDATE per distinct change in count. A burst of clicks costs a few
+statements and one commit instead of three statements and a commit each.
+
+The price is that a like reaches the database (and other pages) up to
+LIKE_BUFFER_SECONDS after the click, and that a worker killed outright
+loses what it had buffered; the buffer is flushed at a normal exit. Form
+posts, which reload the page, are always written straight away.
+"""
+
+import atexit
+import logging
+import os
+import threading
+from collections import defaultdict
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Like, User
+
+log = logging.getLogger(__name__)
+
+
+class LikeBuffer:
+    """Collects like/unlike events and writes them in batches.
+
+    `forget(*user_ids)` is called, inside the writing transaction, with the
+    users whose likes_count changed (app.py's `forget_users`).
+
+    Settings (app.config):
+
+    - LIKE_BUFFER_ENABLED: buffer likes at all (default False)
+    - LIKE_BUFFER_SECONDS: how often the buffer is written (default 0.05)
+    - LIKE_BUFFER_MAX_SIZE: events that trigger an early write (default 1000)
+    """
+
+    def __init__(self, forget=None):
+        self.forget = forget
+        self.enabled = False
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.setdefault('LIKE_BUFFER_ENABLED', False)
+        self.interval = app.config.setdefault('LIKE_BUFFER_SECONDS', 0.05)
+        self.max_size = app.config.setdefault('LIKE_BUFFER_MAX_SIZE', 1000)
+
+    def add(self, user_id, message_id, liked):
+        """Record that `user_id` liked (or, if not `liked`, unliked)
+        `message_id`. Only the latest event per pair is written."""
+
+        with self._lock:
+            self._start()
+            self._pending[(user_id, message_id)] = liked
+            full = len(self._pending) >= self.max_size
+
+        if full:
+            self._wake.set()
+
+    def start(self):
+        """Start this process's writer thread, once per process (so it works
+        after gunicorn forks)."""
+
+        with self._lock:
+            self._start()
+
+    def _start(self):
+        """`start`, with `_lock` held, so that two requests can't both start
+        a thread and no event is added before the thread exists."""
+
+        if self._pid == os.getpid():
+            return
+
+        if self._pid is not None:
+            # forked: what's pending was copied from the parent, which
+            # writes it itself. Nothing of this process's can be queued yet,
+            # since adding an event starts the thread first.
+            self._pending.clear()
+
+        self._pid = os.getpid()
+        self._wake = threading.Event()
+
+        thread = threading.Thread(target=self._run,
+                                  name='like-buffer',
+                                  daemon=True)
+        thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+            try:
+                self.flush()
+            except Exception:
+                log.exception("couldn't write buffered likes")
+
+    def flush(self):
+        """Write everything buffered so far."""
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        if not pending:
+            return
+
+        likes = [pair for pair, liked in pending.items() if liked]
+        unlikes = [pair for pair, liked in pending.items() if not liked]
+
+        with self.app.app_context():
+            try:
+                self._write(likes, unlikes)
+            except IntegrityError:
+                # a user or message in the batch has been deleted since; write
+                # the events one at a time so only theirs are lost
+                db.session.rollback()
+                for pair, liked in pending.items():
+                    try:
+                        self._write([pair] if liked else [],
+                                    [] if liked else [pair])
+                    except IntegrityError:
+                        db.session.rollback()
+                        log.warning("dropped like of message %s by user %s",
+                                    pair[1], pair[0])
+
+    def _write(self, likes, unlikes):
+        """Write one batch and the counts it changes, in one transaction."""
+
+        deltas = Like.add_many(likes)
+        deltas.subtract(Like.remove_many(unlikes))
+
+        users_by_delta = defaultdict(list)
+        for user_id, delta in sorted(deltas.items()):
+            if delta:
+                users_by_delta[delta].append(user_id)
+
+        for delta, user_ids in users_by_delta.items():
+            User.adjust_counts(user_ids, likes_count=delta)
+
+        changed = [user_id for user_ids in users_by_delta.values()
+                   for user_id in user_ids]
+        if changed and self.forget:
+            self.forget(*changed)
+
+        db.session.commit()